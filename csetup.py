@@ -4,10 +4,12 @@ Usage:
 
     import cmplay
     cmplay.main(path)
+
+smf picks up the compiled csmf module by itself.
 """
 from distutils.core import setup
 from Cython.Build import cythonize
 
 setup(
-    ext_modules = cythonize("cmplay.pyx")
+    ext_modules = cythonize(["cmplay.pyx", "csmf.pyx"])
 )
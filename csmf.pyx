@@ -0,0 +1,230 @@
+# cython: language_level=3, wraparound=False, binding=True
+"""
+Compiled versions of the smf parsing and dispatch loops.
+
+smf imports this module when it has been built and uses its own pure
+Python code otherwise. Every function here must behave exactly like
+the one it replaces. execute and playprogram are installed as SMF
+methods, which needs `binding` (the default only from Cython 3 on).
+"""
+from cpython cimport array
+
+# playback program opcodes, as in smf
+cdef enum:
+    NOP, SEND, NOTEOFF, NOTEON, CONTROL, PROGRAM, META
+
+
+cdef inline int number(const unsigned char[:] mf, Py_ssize_t *off,
+                       unsigned long long *value) except -1:
+    # returns 0 for a quantity too long to be held in 56 bits
+    cdef unsigned char byte
+    cdef int count = 0
+    value[0] = 0
+    while True:
+        byte = mf[off[0]]
+        off[0] += 1
+        value[0] = (value[0] << 7) + (byte & 0x7f)
+        if not byte & 0x80:
+            return 1
+        count += 1
+        if count == 8:
+            return 0
+
+
+def decode(mf, Py_ssize_t off, Py_ssize_t end, ev, at=0, status=0,
+           Py_ssize_t limit=0, fallback=None):
+    # events with numbers too large for C integers, which only corrupt
+    # files have, are left to `fallback`, the pure Python decoder
+    cdef const unsigned char[:] buf = mf
+    cdef array.array ticks = ev.tick
+    cdef array.array messages = ev.status
+    cdef array.array data1 = ev.data1
+    cdef array.array data2 = ev.data2
+    cdef unsigned long long tick = at
+    cdef int running = status
+    cdef int me, me_type, byte1, byte2
+    cdef unsigned long long delta, num_bytes
+    cdef Py_ssize_t start, n = len(ticks)
+    while off < end:
+        start = off
+        if not number(buf, &off, &delta) or tick + delta >= 1 << 62:
+            return fallback(mf, start, end, ev, tick, running, limit)
+        tick += delta
+        me = buf[off]
+        off += 1
+        if me < 0xf0:
+            if me & 0x80:
+                running = me
+                byte1 = buf[off] & 0x7f
+                off += 1
+            else:
+                byte1 = me
+            if running < 0xf0:
+                if running & 0xe0 == 0xc0:
+                    byte2 = 0
+                else:
+                    byte2 = buf[off] & 0x7f
+                    off += 1
+                if tick > 0xffffffff:
+                    raise OverflowError(
+                        'unsigned int is greater than maximum')
+                array.resize_smart(ticks, n + 1)
+                array.resize_smart(messages, n + 1)
+                array.resize_smart(data1, n + 1)
+                array.resize_smart(data2, n + 1)
+                ticks.data.as_uints[n] = <unsigned int>tick
+                messages.data.as_uchars[n] = running | 0x80
+                data1.data.as_uchars[n] = byte1
+                data2.data.as_uints[n] = byte2
+                n += 1
+            else:
+                print('Corrupt MIDI file')
+        elif me == 0xf0 or me == 0xf7:
+            if not number(buf, &off, &num_bytes):
+                return fallback(mf, start, end, ev, tick - delta, running,
+                                limit)
+            off += num_bytes
+        elif me == 0xff:
+            me_type = buf[off]
+            off += 1
+            if not number(buf, &off, &num_bytes):
+                return fallback(mf, start, end, ev, tick - delta, running,
+                                limit)
+            if me_type <= 0x0f:
+                ev.appendmeta(tick, me_type, mf, off, num_bytes)
+            elif me_type == 0x20 or me_type == 0x21:
+                ev.appendmeta(tick, me_type, mf, off, 1)
+            elif me_type == 0x2f:
+                return off, tick, None
+            elif me_type == 0x51:
+                ev.appendmeta(tick, me_type, mf, off, 3)
+            elif me_type == 0x58:
+                ev.appendmeta(tick, me_type, mf, off, 4)
+            elif me_type == 0x59:
+                ev.appendmeta(tick, me_type, mf, off, 2)
+            n = len(ticks)
+            off += num_bytes
+        else:
+            running = me
+            off += 1
+            print('Corrupt MIDI file')
+        if limit and n >= limit:
+            return off, tick, running
+    return off, tick, None
+
+
+def execute(self, int op, buf):
+    cdef int port = self.port
+    cdef int channel = port << 4 | buf[0] & 0x0f
+    cdef int byte1, velocity, key, count
+    cdef list held, pitches
+    cdef array.array chordal = self.chordal
+    mixer = self.mixer
+    mixer.used[channel] = True
+    if op == NOTEOFF or op == NOTEON:
+        byte1 = buf[1]
+        if channel & 0x0f != 9 and self.key_shift:
+            byte1 += self.key_shift
+            buf = [buf[0], byte1, buf[2]]
+        velocity = buf[2]
+        key = channel << 8 | byte1 & 0xff
+        held = self.held
+        count = held[key]
+        if op == NOTEOFF or velocity == 0:
+            velocity = 0
+            if count:
+                held[key] = count - 1
+                if count == 1:
+                    mixer.notes[channel].remove(byte1)
+                    if chordal.data.as_uchars[channel]:
+                        pitches = self.pitches
+                        pitches[byte1 % 12] -= 1
+        else:
+            if count:
+                print('Note retriggered')
+            else:
+                mixer.notes[channel].append(byte1)
+                if chordal.data.as_uchars[channel]:
+                    pitches = self.pitches
+                    pitches[byte1 % 12] += 1
+            held[key] = count + 1
+            if not mixer.muted[channel]:
+                mixer.intensity[channel] = velocity
+        mixer.velocity[channel] = velocity
+    elif op == CONTROL:
+        control = mixer.controls.get(buf[1])
+        if control is not None:
+            control[channel] = buf[2]
+            if buf[1] == 7 and self.gain != 1:
+                buf = [buf[0], 7, int(buf[2] * self.gain)]
+    elif op == PROGRAM:
+        from smf import instruments, families
+        mixer.name[channel] = instruments[buf[1]]
+        mixer.instrument[channel] = buf[1]
+        mixer.family[channel] = families[buf[1] // 8]
+        counted = channel & 0x0f != 9 and \
+            mixer.family[channel] != 'Bass' and self.chordmap is None
+        if counted != chordal.data.as_uchars[channel]:
+            for note in mixer.notes[channel]:
+                self.pitches[note % 12] += 1 if counted else -1
+            chordal.data.as_uchars[channel] = counted
+    if not mixer.muted[channel]:
+        self.writemidi(buf)
+
+
+def playprogram(self, wait):
+    cdef array.array times = self.program.time
+    cdef array.array opcode = self.program.opcode
+    cdef array.array ticks = self.ev.tick
+    cdef list message = self.program.message
+    cdef array.array port = self.program.port
+    cdef double due, now, ahead = 0, speed = self.speed
+    cdef double elapsed = self.elapsed_time, midi_clock
+    cdef Py_ssize_t i, n = len(times)
+    cdef int op
+    execute = self.execute
+    batch = self.batch
+    clock = self.clock
+    if batch is not None and self.timestamps:
+        ahead = self.lookahead * speed
+    now = (clock.time() - elapsed) * speed
+    midi_clock = self.midi_clock
+    while self.next < n:
+        i = self.next
+        due = times.data.as_doubles[i]
+        if due > now + ahead:
+            now = (clock.time() - elapsed) * speed
+        while due > now + ahead:
+            if batch is not None:
+                self.stamp = max(elapsed + (now + ahead) / speed,
+                                 self.scheduled)
+            self.timing(ticks.data.as_uints[i])
+            self.flush()
+            delta = min((due - ahead - now) / speed,
+                        1.0 / (self.division / 24))
+            if wait:
+                clock.sleep(delta)
+                now = (clock.time() - elapsed) * speed
+            else:
+                return delta
+        if batch is not None:
+            stamp = elapsed + due / speed
+            if stamp < self.scheduled:
+                stamp = self.scheduled
+            self.stamp = stamp
+        if ticks.data.as_uints[i] >= midi_clock:
+            self.timing(ticks.data.as_uints[i])
+            midi_clock = self.midi_clock
+        op = opcode.data.as_uchars[i]
+        if op == META:
+            self.metaevent(ticks.data.as_uints[i], self.ev.data1[i],
+                           message[i])
+            speed = self.speed
+            elapsed = self.elapsed_time
+        elif op != NOP:
+            if port is not None:
+                self.port = port.data.as_uchars[i]
+            execute(op, message[i])
+        self.next = i + 1
+    self.writemidi([0xfc])
+    return 0
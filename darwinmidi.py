@@ -2,6 +2,11 @@ import sys
 from ctypes import *
 import ctypes.util
 
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import time as clock
+
 kCFStringEncodingUTF8 = 0x08000100
 
 cf = CDLL(ctypes.util.find_library("CoreFoundation"))
@@ -125,6 +130,18 @@ _paramflags = (
 MIDIClientDispose = _prototype(("MIDIClientDispose", midi), _paramflags)
 
 
+class mach_timebase_info_data_t(Structure):
+    _fields_ = [("numer", c_uint32),
+                ("denom", c_uint32)]
+
+
+libc = CDLL(ctypes.util.find_library("c"))
+mach_absolute_time = libc.mach_absolute_time
+mach_absolute_time.restype = c_uint64
+mach_timebase_info = libc.mach_timebase_info
+mach_timebase_info.argtypes = [POINTER(mach_timebase_info_data_t)]
+
+
 class AudioComponentDescription(ctypes.Structure):
     _fields_ = [("componentType", ctypes.c_uint32),
                 ("componentSubType", ctypes.c_uint32),
@@ -139,6 +156,10 @@ def fatal(message):
 
 
 class CoreMidiDevice:
+    batch = True
+    timestamps = True
+    sysex = True
+
     def __init__(self):
         name = CFStringCreateWithCString(None, "mplay", kCFStringEncodingUTF8)
         outputPort = CFStringCreateWithCString(None, "Output port",
@@ -172,6 +193,10 @@ class CoreMidiDevice:
 
         self.pktlist = MIDIPacketList()
 
+        timebase = mach_timebase_info_data_t()
+        mach_timebase_info(byref(timebase))
+        self.rate = 1e9 * timebase.denom / timebase.numer
+
     def midievent(self, buf):
         pktlist = MIDIPacketListInit(byref(self.pktlist))
         packet = pktlist.contents
@@ -186,6 +211,28 @@ class CoreMidiDevice:
         if MIDISend(self.port, self.dest, byref(self.pktlist)) != 0:
             fatal('cannot send MIDI packet')
 
+    def midievents(self, events):
+        now = clock()
+        host = mach_absolute_time()
+        packet = MIDIPacketListInit(byref(self.pktlist))
+        for stamp, buf in events:
+            if stamp > now:
+                timestamp = host + int((stamp - now) * self.rate)
+            else:
+                timestamp = 0
+            data = (c_ubyte * len(buf))(*buf)
+            packet = MIDIPacketListAdd(self.pktlist, sizeof(self.pktlist),
+                                       packet, timestamp, len(buf), data)
+            if not packet:
+                if MIDISend(self.port, self.dest, byref(self.pktlist)) != 0:
+                    fatal('cannot send MIDI packet')
+                packet = MIDIPacketListInit(byref(self.pktlist))
+                packet = MIDIPacketListAdd(self.pktlist, sizeof(self.pktlist),
+                                           packet, timestamp, len(buf), data)
+        if self.pktlist.numPackets:
+            if MIDISend(self.port, self.dest, byref(self.pktlist)) != 0:
+                fatal('cannot send MIDI packet')
+
     def mididataset1(self, address, data):
         sysex = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
         sysex[0] = 0xf0
@@ -207,6 +254,10 @@ class CoreMidiDevice:
 
 
 class DLSSynth:
+    batch = False
+    timestamps = False
+    sysex = True
+
     def FOUR_CHAR_CODE(self, code):
         value = 0
         for i in range(4):
@@ -257,6 +308,10 @@ class DLSSynth:
         byte3 = 0
         self.au.MusicDeviceMIDIEvent(self.outSynth, me, byte1, byte2, byte3)
 
+    def midievents(self, events):
+        for stamp, buf in events:
+            self.midievent(buf)
+
     def mididataset1(self, address, data):
         sysex = (ctypes.c_ubyte * 11)()
         sysex[0] = 0xf0
@@ -277,15 +332,25 @@ class DLSSynth:
 
 
 class midiDevice:
+    batch = True
+    timestamps = True
+    sysex = True
+
     def __init__(self):
         if MIDIGetDestination(0) != 0:
             self.device = CoreMidiDevice()
         else:
             self.device = DLSSynth()
+        self.batch = self.device.batch
+        self.timestamps = self.device.timestamps
+        self.ports = max(midi.MIDIGetNumberOfDestinations(), 1)
 
     def midievent(self, buf):
         self.device.midievent(buf)
 
+    def midievents(self, events):
+        self.device.midievents(events)
+
     def mididataset1(self, address, data):
         self.device.mididataset1(address, data)
 
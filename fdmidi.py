@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import os
+
+import mididevices
+
+default = os.environ.get('MPLAY_RAWMIDI', '/dev/snd/midiC0D0')
+available = os.path.exists(default)
+
+
+class midiDevice:
+    """Writes raw MIDI bytes to a file descriptor.
+
+    `target` is a descriptor (an ALSA rawmidi node, a FIFO, a socket or
+    a pipe opened elsewhere) or the path of one to open, by default
+    $MPLAY_RAWMIDI or the first rawmidi node. All messages of a batch,
+    which the player collects per tick, go out in a single write.
+    """
+
+    batch = True
+    timestamps = False
+    sysex = True
+    ports = 1
+
+    def __init__(self, target=None):
+        if target is None:
+            target = default
+        if isinstance(target, int):
+            self.fd = target
+            self.owned = False
+        else:
+            self.fd = os.open(target, os.O_WRONLY)
+            self.owned = True
+        self.writes = 0
+
+    def write(self, data):
+        data = memoryview(data)
+        while len(data):
+            data = data[os.write(self.fd, data):]
+        self.writes += 1
+
+    def midievent(self, buf):
+        self.write(bytearray(buf))
+
+    def midievents(self, events):
+        data = bytearray()
+        for stamp, buf in events:
+            data.extend(buf)
+        if data:
+            self.write(data)
+
+    def mididataset1(self, address, data):
+        self.midievent(mididevices.dataset1(address, data))
+
+    def close(self):
+        if self.owned and self.fd >= 0:
+            os.close(self.fd)
+        self.fd = -1
+
+
+def pipetest(path, seconds=10):
+    """Plays `path` into a pipe and checks what comes out the other end.
+
+    Reports how many writes the messages took and whether the bytes
+    read back are exactly those the player sent.
+    """
+    import threading
+    import smf
+    import sinkmidi
+
+    midi = smf.read(path)
+    rfd, wfd = os.pipe()
+    received = bytearray()
+
+    def drain():
+        while True:
+            data = os.read(rfd, 65536)
+            if not data:
+                break
+            received.extend(data)
+
+    reader = threading.Thread(target=drain)
+    reader.daemon = True
+    reader.start()
+    device = midiDevice(wfd)
+    sent = sinkmidi.midiDevice()
+    midievent, midievents = device.midievent, device.midievents
+
+    def tee(buf):
+        sent.midievent(buf)
+        midievent(buf)
+
+    def teeall(events):
+        sent.midievents(events)
+        midievents(events)
+
+    device.midievent, device.midievents = tee, teeall
+    try:
+        end = smf.clock() + seconds
+        while smf.clock() < end:
+            delta = midi.play(device, wait=False)
+            if delta <= 0:
+                break
+            smf.sleep(delta)
+    finally:
+        # the reader only stops once the write end is closed
+        os.close(wfd)
+        reader.join()
+        os.close(rfd)
+    expected = b''.join(buf for at, buf in sent.log)
+    print('%d messages, %d bytes in %d writes (%.1f messages/write), '
+          '%s' % (len(sent.log), len(expected), device.writes,
+                  len(sent.log) / max(device.writes, 1),
+                  'intact' if bytes(received) == expected else 'CORRUPTED'))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: fdmidi.py file [seconds]')
+        sys.exit(1)
+    pipetest(sys.argv[1], *[float(arg) for arg in sys.argv[2:3]])
@@ -1,14 +1,28 @@
 try:
     import pypm as pm
-except:
-    print('unable to import portmidi module')
+    available = True
+except ImportError:
+    available = False
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import time as clock
 
 
 class midiDevice:
+    batch = True
+    timestamps = True
+    sysex = False
+    ports = 1
+    latency = 1
+
     def __init__(self):
+        if not available:
+            print('unable to import portmidi module')
         try:
             pm.Initialize()
-            self.device = pm.Output(0)
+            self.device = pm.Output(0, self.latency)
         except:
             self.device = None
 
@@ -21,6 +35,15 @@ class midiDevice:
             elif len(buf) == 3:
                 self.device.WriteShort(buf[0], buf[1], buf[2])
 
+    def midievents(self, events):
+        if self.device != None:
+            now = clock()
+            start = pm.Time() - self.latency
+            events = [[list(buf), max(int(start + (stamp - now) * 1000), 0)]
+                      for stamp, buf in events]
+            for i in range(0, len(events), 1024):
+                self.device.Write(events[i:i + 1024])
+
     def mididataset1(self, address, data):
         pass
 
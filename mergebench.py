@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Times putting the events of format 1 files in order.
+
+    mergebench.py [file|tracks ...]
+
+Each argument is a file, or a number of tracks for a generated song
+(16, 64 and 128 by default). Reports the median time of a stable sort
+permutation over the ticks, as read() used to do, and of
+EventStore.merge, and checks that both give the same order.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import os
+import random
+import struct
+from array import array
+
+import smf
+from smf import EventStore, clock
+
+columns = ('tick', 'status', 'data1', 'data2', 'port')
+
+
+def number(value):
+    data = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        data.insert(0, value & 0x7f | 0x80)
+        value >>= 7
+    return data
+
+
+def generate(tracks, steps=250, seed=1):
+    """A format 1 song of `tracks` parts: chords of one to four notes,
+    some with an expression sweep, in phrases separated by rests."""
+    rnd = random.Random(seed)
+    mf = bytearray(b'MThd' + struct.pack('>IHHH', 6, 1, tracks, 96))
+    for track in range(tracks):
+        channel = track % 16
+        data = bytearray(b'\x00\xff\x21\x01') + bytearray((track % 2,))
+        for step in range(steps):
+            wait = rnd.choice((0, 48, 96))
+            if step % 16 == 0 and rnd.random() < 0.5:
+                wait += 8 * 4 * 96
+            keys = rnd.sample(range(36, 96), rnd.randint(1, 4))
+            for key in keys:
+                data += number(wait) + bytearray((0x90 | channel, key, 100))
+                wait = 0
+            length = 96
+            if rnd.random() < 0.3:
+                for value in range(0, 128, 8):
+                    data += number(6) + bytearray((0xb0 | channel, 11, value))
+                    length -= 6
+            for key in keys:
+                data += number(length) + bytearray((0x80 | channel, key, 0))
+                length = 0
+        data += b'\x00\xff\x2f\x00'
+        mf += b'MTrk' + struct.pack('>I', len(data)) + data
+    return mf
+
+
+def decode(mf):
+    # the events of each track, one run after the other, as read() has
+    # them before merging
+    ev = EventStore()
+    runs = []
+    tracks = struct.unpack_from('>H', mf, 10)[0]
+    off = 8 + struct.unpack_from('>I', mf, 4)[0]
+    while len(runs) < tracks and off + 8 <= len(mf):
+        chunk = bytes(mf[off: off + 4])
+        end = off + 8 + struct.unpack_from('>I', mf, off + 4)[0]
+        if chunk == b'MTrk':
+            runs.append(len(ev))
+            smf.decode(mf, off + 8, min(end, len(mf)), ev)
+        off = end
+    ev.route(runs)
+    return ev, runs
+
+
+def sort(ev, runs):
+    order = sorted(range(len(ev.tick)), key=ev.tick.__getitem__)
+    for column in columns:
+        values = getattr(ev, column)
+        setattr(ev, column, array(values.typecode,
+                                  [values[i] for i in order]))
+
+
+def compare(name, mf, repeat=7):
+    unmerged, runs = decode(mf)
+    times = {}
+    results = {}
+    for method, order in (('sort', sort), ('merge', EventStore.merge)):
+        elapsed = []
+        for i in range(repeat):
+            ev = EventStore(unmerged.pool)
+            for column in columns:
+                values = getattr(unmerged, column)
+                setattr(ev, column, array(values.typecode, values))
+            start = clock()
+            order(ev, runs)
+            elapsed.append(clock() - start)
+        times[method] = sorted(elapsed)[repeat // 2]
+        results[method] = [getattr(ev, column) for column in columns]
+    if results['sort'] != results['merge']:
+        print('%s: orders differ' % name)
+    print('%-12s %4d tracks %8d events  sort %7.1f ms  merge %7.1f ms' % (
+        name, len(runs), len(unmerged), 1000 * times['sort'],
+        1000 * times['merge']))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] in (['-h'], ['--help']):
+        print('usage: mergebench.py [file|tracks ...]')
+        sys.exit(1)
+    for arg in sys.argv[1:] or ['16', '64', '128']:
+        if arg.isdigit():
+            compare('generated', generate(int(arg)))
+        else:
+            stream = open(arg, 'rb')
+            compare(os.path.basename(arg), bytearray(stream.read()))
+            stream.close()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+The MIDI output backends, loaded only when asked for.
+
+    device = mididevices.open()           # $MPLAY_BACKEND or the first
+                                          # backend that loads here
+    device = mididevices.open('sink')     # by name
+    device = mididevices.open('net', 'synths.local', 5004)
+
+Each backend module provides a midiDevice class telling what the device
+can do, and may set `available` to False if it cannot work here:
+
+    batch       midievents() hands over many messages at once
+    timestamps  midievents() plays messages at the times given
+    sysex       mididataset1() sends system exclusive messages
+    ports       the number of output ports
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import os
+
+# name, module, platform prefix (None for any), in the order probed
+backends = [('coremidi', 'darwinmidi', 'darwin'),
+            ('winmm', 'win32midi', 'win32'),
+            ('portmidi', 'linux2midi', 'linux'),
+            ('rawmidi', 'fdmidi', 'linux'),
+            ('net', 'netmidi', None),
+            ('sink', 'sinkmidi', None)]
+loaded = {}
+defaults = (('batch', False), ('timestamps', False), ('sysex', False),
+            ('ports', 1))
+
+
+def register(name, module, platform=None):
+    backends.insert(len(backends) - 1, (name, module, platform))
+
+
+def names():
+    return [name for name, module, platform in backends]
+
+
+def load(name):
+    if name not in loaded:
+        for backend, module, platform in backends:
+            if backend == name:
+                break
+        else:
+            raise ValueError('unknown MIDI backend %r' % name)
+        __import__(module)
+        loaded[name] = sys.modules[module].midiDevice
+    return loaded[name]
+
+
+def probe():
+    # the network and the sink need to be asked for by name
+    for name, module, platform in backends:
+        if platform is None or not sys.platform.startswith(platform):
+            continue
+        try:
+            load(name)
+        except (ImportError, OSError, AttributeError):
+            continue
+        if getattr(sys.modules[module], 'available', True):
+            return name
+    return None
+
+
+def open(name=None, *args):
+    name = name or os.environ.get('MPLAY_BACKEND') or probe()
+    if name is None:
+        raise ImportError('no MIDI backend available, '
+                          'try setting MPLAY_BACKEND')
+    return load(name)(*args)
+
+
+def dataset1(address, data):
+    # a Roland DT1 (data set 1) system exclusive message setting one
+    # byte of the synth's parameters at `address`
+    sysex = [0xf0, 0x41, 0x10, 0x42, 0x12, (address >> 16) & 0xff,
+             (address >> 8) & 0xff, address & 0xff, data]
+    sysex += [128 - (sum(sysex[5:9]) % 128), 0xf7]
+    return sysex
+
+
+def capabilities(device):
+    return dict((key, getattr(device, key, value))
+                for key, value in defaults)
+
+
+if __name__ == '__main__':
+    for name in names():
+        try:
+            load(name)
+        except (ImportError, OSError, AttributeError) as e:
+            print('%-9s unavailable (%s)' % (name, e))
+            continue
+        print('%-9s %s' % (name, ' '.join(
+            '%s=%s' % (key, getattr(loaded[name], key, value))
+            for key, value in defaults)))
+    print('default: %s' % (os.environ.get('MPLAY_BACKEND') or probe()))
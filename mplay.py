@@ -24,15 +24,10 @@ from OpenGL.GL import (glBegin, glEnd, glColor3f, glLoadIdentity, glMatrixMode,
                        GL_NEAREST, GL_PROJECTION, GL_QUADS, GL_RGB,
                        GL_UNPACK_ALIGNMENT, GL_UNSIGNED_BYTE)
 
-from smf import read, play, fileinfo, songinfo, beatinfo, lyrics, chordinfo, \
-    setsong, channelinfo, setchannel, families, instruments
-
-if sys.platform == 'darwin':
-    from darwinmidi import midiDevice
-elif sys.platform == 'win32':
-    from win32midi import midiDevice
-elif sys.platform == 'linux2':
-    from linux2midi import midiDevice
+from smf import fileinfo, songinfo, beatinfo, lyrics, chordinfo, \
+    setsong, channelinfo, decay, families, instruments
+from smfplayer import Playlist
+import mididevices
 
 MUTE_ON_OFF = {b'b': ['Bass'], b'g': ['Guitar'],
                b'k': ['Piano', 'Organ', 'Strings', 'Ensemble']}
@@ -118,10 +113,9 @@ def paint_notes(notes):
 
 
 class Player:
-    def __init__(self, win, path, width, height):
+    def __init__(self, win, paths, width, height):
         self.win = win
-        self.midi = read(path)
-        self.device = midiDevice()
+        self.device = mididevices.open()
         self.muted = 16 * [False]
         self.solo = 16 * [False]
         self.width = width
@@ -129,8 +123,12 @@ class Player:
         self.button = False
         self.selection = None
         self.pause = False
+        self.scheduler = Playlist(paths, self.device, lookahead=0.05)
+        self.midi = self.scheduler.midi
+        self.scheduler.start()
 
     def update(self):
+        self.midi = self.scheduler.midi
         copy_pixels(0, 0, 730, 650, 0, 0)
         for channel in range(16):
             color = 0 if channel != self.selection else 2
@@ -166,10 +164,7 @@ class Player:
             copy_pixels(x - 6, 204, 12, 91, 4, 204)
             copy_pixels(x - 6, 219 + level // 2, 12, 11, 735, 225)
             copy_pixels(x + 13, 219, 12, info['intensity'] // 2, 754, 219)
-            if info['intensity'] >= 4:
-                info['intensity'] -= 4
-            else:
-                info['intensity'] = 0
+        decay(self.midi, 4)
 
         draw_text(15, 177, fileinfo(self.midi))
         draw_text(15, 162, songinfo(self.midi))
@@ -191,19 +186,19 @@ class Player:
             copy_pixels(665, 251, 10, 10, 860, 604)
 
     def change_mute_state(self, channel):
-        setchannel(self.midi, channel, muted=self.muted[channel])
+        self.scheduler.setchannel(channel, muted=self.muted[channel])
 
     def change_solo_state(self, channel):
         self.solo[channel] = not self.solo[channel]
         if self.solo[channel]:
-            setchannel(self.midi, channel, solo=self.solo[channel])
+            self.scheduler.setchannel(channel, solo=self.solo[channel])
             for ch in range(16):
                 self.muted[ch] = True if ch != channel else False
                 self.solo[ch] = True if ch == channel else False
         else:
             for ch in range(16):
                 self.muted[ch] = False
-                setchannel(self.midi, ch, muted=False)
+                self.scheduler.setchannel(ch, muted=False)
 
     def display_func(self):
         self.update()
@@ -212,6 +207,7 @@ class Player:
     # noinspection PyUnusedLocal
     def keyboard_func(self, key, x, y):
         if key == b'\x1b':
+            self.scheduler.stop()
             setsong(self.midi, action='exit')
             sys.exit(0)
         elif key == b'\t':
@@ -224,7 +220,7 @@ class Player:
                 self.selection = (self.selection + 1) % 16
                 info = channelinfo(self.midi, self.selection)
         elif key == b' ':
-            setsong(self.midi, action='pause')
+            self.scheduler.setsong(action='pause')
             self.pause = not self.pause
         elif key in b'1234567890!@#$%^':
             channel = b'1234567890!@#$%^'.index(key)
@@ -255,24 +251,24 @@ class Player:
                     self.solo[channel] = False
                 self.change_mute_state(channel)
         elif key == b'<':
-            setsong(self.midi, shift=-1)
+            self.scheduler.setsong(shift=-1)
         elif key == b'>':
-            setsong(self.midi, shift=+1)
+            self.scheduler.setsong(shift=+1)
         elif key == b'-':
-            setsong(self.midi, bpm=-1)
+            self.scheduler.setsong(bpm=-1)
         elif key == b'+':
-            setsong(self.midi, bpm=+1)
+            self.scheduler.setsong(bpm=+1)
 
     def mouse_func(self, button, state, x, y):
         self.button = button == GLUT_LEFT_BUTTON and state == GLUT_DOWN
         if 630 < x < 710 and self.button:
             if 360 < y < 370:
-                setsong(self.midi, bar=-1)
+                self.scheduler.setsong(bar=-1)
             elif 390 < y < 400:
-                setsong(self.midi, action='pause')
+                self.scheduler.setsong(action='pause')
                 self.pause = not self.pause
             elif 420 < y < 430:
-                setsong(self.midi, bar=+1)
+                self.scheduler.setsong(bar=+1)
             return
         elif x >= 608:
             return
@@ -299,30 +295,29 @@ class Player:
                 value = int(min(max(value, 0), 127))
                 knob = y // 58
                 if knob == 0:
-                    setchannel(self.midi, channel, sense=value)
+                    self.scheduler.setchannel(channel, sense=value)
                 elif knob == 1:
-                    setchannel(self.midi, channel, delay=value)
+                    self.scheduler.setchannel(channel, delay=value)
                 elif knob == 2:
-                    setchannel(self.midi, channel, chorus=value)
+                    self.scheduler.setchannel(channel, chorus=value)
                 elif knob == 3:
-                    setchannel(self.midi, channel, reverb=value)
+                    self.scheduler.setchannel(channel, reverb=value)
                 elif knob == 4:
-                    setchannel(self.midi, channel, pan=value)
+                    self.scheduler.setchannel(channel, pan=value)
             elif 358 < y < 430:
                 value = min(max((425 - y) * 2, 0), 127)
-                setchannel(self.midi, channel, level=value)
+                self.scheduler.setchannel(channel, level=value)
 
     def process_events(self):
-        delta = play(self.midi, self.device, wait=False)
         glutPostRedisplay()
-        if delta > 0:
-            sleep(delta)
+        if self.scheduler.is_alive():
+            sleep(1 / 60)
         else:
             sys.exit(0)
 
     def change_instrument(self, value):
         if self.selection:
-            setchannel(self.midi, self.selection, instrument=value)
+            self.scheduler.setchannel(self.selection, instrument=value)
         return 0
 
 
@@ -340,14 +335,14 @@ def dialog():
     return None
 
 
-def main(path=None):
+def main(*paths):
     glutInit(sys.argv)
 
     if sys.platform == 'darwin':
-        if not path:
-            path = dialog()
+        if not paths:
+            paths = [path for path in [dialog()] if path]
 
-    if not path:
+    if not paths:
         sys.exit(0)
 
     glutInitDisplayMode(GLUT_RGB | GLUT_DOUBLE)
@@ -373,7 +368,7 @@ def main(path=None):
     glLoadIdentity()
     glOrtho(0, 730, 0, 650, 0, 1)
 
-    player = Player(win, path, width, height)
+    player = Player(win, paths, width, height)
 
     glutDisplayFunc(player.display_func)
     glutKeyboardFunc(player.keyboard_func)
@@ -396,7 +391,4 @@ def main(path=None):
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        main(sys.argv[1])
-    else:
-        main()
+    main(*sys.argv[1:])
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+MIDI over UDP, one datagram per batch of messages.
+
+Datagrams follow the RTP-MIDI layout (RFC 6295) without a recovery
+journal: a 12 byte RTP header with a sequence number, timestamp (in
+1/10000 s) and source id, then the MIDI command section, in which every
+command after the first is preceded by its delta time to the one
+before it.
+netreceiver replays them into a local midiDevice.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import os
+import random
+import socket
+import struct
+
+import mididevices
+from smf import clock
+
+header = struct.Struct('>BBHII')
+version = 0x80
+payload_type = 0x61
+rate = 10000  # timestamp units per second
+max_payload = 1024
+address = os.environ.get('MPLAY_NETMIDI', '127.0.0.1:5004')
+
+
+def number(value):
+    data = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        data.insert(0, value & 0x7f | 0x80)
+        value >>= 7
+    return data
+
+
+def packet(sequence, source, events):
+    """Encodes (stamp, message) pairs as an RTP-MIDI datagram.
+
+    Raises ValueError if the commands do not fit the 4095 bytes a
+    command section can hold; messages are not split over datagrams.
+    """
+    # a message may hold several commands, such as stop and start, and
+    # each needs a delta time of its own; padding after a command, like
+    # the third byte the player gives channel pressure, is left out
+    commands = bytearray()
+    first = previous = None
+    for at, buf in events:
+        buf = bytearray(buf)
+        off = 0
+        while off < len(buf) and buf[off] & 0x80:
+            if first is None:
+                first = at
+            else:
+                commands += number(max(int(at * rate) - int(previous * rate),
+                                       0))
+            previous = at
+            n = length(buf, off, buf[off])
+            commands += buf[off: off + n]
+            off += n
+    if len(commands) > 0x0fff:
+        raise ValueError('%d bytes of MIDI commands do not fit a datagram'
+                         % len(commands))
+    if len(commands) > 0x0f:
+        section = bytearray((0x80 | len(commands) >> 8, len(commands) & 0xff))
+    else:
+        section = bytearray((len(commands),))
+    return header.pack(version, payload_type, sequence & 0xffff,
+                       int(first * rate) & 0xffffffff, source) + \
+        bytes(section + commands)
+
+
+def length(data, off, status):
+    # the number of bytes of the command at data[off:]
+    if status == 0xf0:
+        return data.index(0xf7, off) + 1 - off
+    if status < 0xf0:
+        return 2 if status & 0xe0 == 0xc0 else 3
+    return {0xf1: 2, 0xf2: 3, 0xf3: 2}.get(status, 1)
+
+
+def unpack(data):
+    """Decodes a datagram into (sequence, timestamp, commands).
+
+    Delta times are dropped; running status is expanded.
+    """
+    flags, kind, sequence, stamp, source = header.unpack_from(data)
+    if flags & 0xc0 != version:
+        raise ValueError('not an RTP packet')
+    off = header.size
+    section = data[off]
+    if section & 0x80:
+        size = (section & 0x0f) << 8 | data[off + 1]
+        off += 2
+    else:
+        size = section & 0x0f
+        off += 1
+    end = off + size
+    commands = []
+    status = 0
+    delta = bool(section & 0x20)
+    while off < end:
+        if delta:
+            while data[off] & 0x80:
+                off += 1
+            off += 1
+        if data[off] & 0x80:
+            status = data[off]
+            n = length(data, off, status)
+            commands.append(data[off: off + n])
+        else:
+            n = length(data, off, status) - 1
+            commands.append(bytearray((status,)) + data[off: off + n])
+        off += n
+        delta = True
+    return sequence, stamp, commands
+
+
+class midiDevice:
+    """Sends MIDI messages to `host`:`port` over UDP.
+
+    The address defaults to $MPLAY_NETMIDI or 127.0.0.1:5004. Each
+    batch the player hands over, normally all messages due at one
+    tick, goes out as one datagram, split only if it would exceed
+    `max_payload` bytes. A single message too long for a datagram, such
+    as a system exclusive message over 4094 bytes, raises ValueError.
+    """
+
+    batch = True
+    timestamps = False
+    sysex = True
+    ports = 1
+
+    def __init__(self, host=None, port=None):
+        default_host, default_port = address.rsplit(':', 1)
+        self.target = (host or default_host, int(port or default_port))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.source = random.getrandbits(32)
+        self.sequence = random.getrandbits(16)
+        self.sent = None
+
+    def send(self, events):
+        if self.sent is not None:
+            self.sent.append((self.sequence, clock()))
+        self.socket.sendto(packet(self.sequence, self.source, events),
+                           self.target)
+        self.sequence = (self.sequence + 1) & 0xffff
+
+    def midievent(self, buf):
+        self.send([(clock(), buf)])
+
+    def midievents(self, events):
+        start = size = 0
+        for i, (stamp, buf) in enumerate(events):
+            if size + len(buf) + 4 > max_payload and i > start:
+                self.send(events[start:i])
+                start, size = i, 0
+            size += len(buf) + 4
+        if start < len(events):
+            self.send(events[start:])
+
+    def mididataset1(self, address, data):
+        self.midievent(mididevices.dataset1(address, data))
+
+    def close(self):
+        self.socket.close()
+
+
+def loopback(path, seconds=10, count=20000, port=5104):
+    """Measures latency and throughput through netreceiver on loopback.
+
+    Plays `path` for up to `seconds` and reports how long datagrams take
+    to be replayed, then sends `count` datagrams of eight messages as
+    fast as possible and reports how many arrive per second.
+    """
+    import threading
+    import smf
+    import sinkmidi
+    from netreceiver import Receiver
+    from smfplayer import report
+
+    received = sinkmidi.midiDevice()
+    receiver = Receiver(received, port, '127.0.0.1')
+    arrived = {}
+    replay = receiver.replay
+
+    def stamped(sequence, commands):
+        arrived[sequence] = clock()
+        replay(sequence, commands)
+
+    receiver.replay = stamped
+    thread = threading.Thread(target=receiver.serve)
+    thread.daemon = True
+    thread.start()
+
+    device = midiDevice('127.0.0.1', port)
+    device.sent = []
+    midi = smf.read(path)
+    end = clock() + seconds
+    while clock() < end:
+        delta = midi.play(device, wait=False)
+        if delta <= 0:
+            break
+        smf.sleep(delta)
+    smf.sleep(0.1)
+    report('latency', [arrived[sequence] - at for sequence, at in
+                       device.sent if sequence in arrived])
+    print('%d datagrams sent, %d received, %d lost, %d messages replayed'
+          % (len(device.sent), receiver.packets, receiver.lost,
+             len(received.log)))
+
+    before = receiver.packets
+    notes = [(0, bytearray((0x90, 60 + i, 100))) for i in range(8)]
+    device.sent = None
+    start = clock()
+    for i in range(count):
+        device.midievents(notes)
+    smf.sleep(0.2)
+    elapsed = clock() - start - 0.2
+    got = receiver.packets - before
+    print('throughput %d of %d datagrams (%.0f/s, %.0f messages/s), '
+          '%d lost' % (got, count, got / elapsed, 8 * got / elapsed,
+                       count - got))
+    receiver.close()
+    device.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: netmidi.py file [seconds [count]]')
+        sys.exit(1)
+    loopback(sys.argv[1], *[float(arg) for arg in sys.argv[2:3]] +
+             [int(arg) for arg in sys.argv[3:4]])
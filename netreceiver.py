@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Replays MIDI datagrams sent by netmidi into a local device.
+
+    netreceiver.py [port [backend]]
+
+Messages are played as soon as their datagram arrives. Datagrams that
+arrive after a later one has already been played are dropped rather
+than played out of order, and gaps in the sequence numbers are counted
+as lost.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import socket
+
+import netmidi
+from smf import clock
+
+
+class Receiver:
+    """Listens on `host`:`port` and replays what arrives into `device`."""
+
+    def __init__(self, device, port=None, host=''):
+        if port is None:
+            port = int(netmidi.address.rsplit(':', 1)[1])
+        self.device = device
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.expected = None
+        self.packets = 0
+        self.messages = 0
+        self.lost = 0
+        self.late = 0
+
+    def receive(self, data):
+        try:
+            sequence, stamp, commands = netmidi.unpack(bytearray(data))
+        except (ValueError, IndexError, TypeError):
+            print('Corrupt MIDI datagram')
+            return
+        if self.expected is not None:
+            gap = (sequence - self.expected) & 0xffff
+            if gap >= 0x8000:
+                self.late += 1
+                return
+            self.lost += gap
+        self.expected = (sequence + 1) & 0xffff
+        self.packets += 1
+        self.messages += len(commands)
+        self.replay(sequence, commands)
+
+    def replay(self, sequence, commands):
+        device = self.device
+        if getattr(device, 'batch', False) and len(commands) > 1:
+            now = clock()
+            device.midievents([(now, buf) for buf in commands])
+        else:
+            for buf in commands:
+                device.midievent(buf)
+
+    def serve(self, seconds=None):
+        end = clock() + seconds if seconds else None
+        while end is None or clock() < end:
+            if end is not None:
+                self.socket.settimeout(max(end - clock(), 0.001))
+            try:
+                data = self.socket.recv(65536)
+            except socket.timeout:
+                break
+            except (OSError, socket.error):
+                break  # closed
+            self.receive(data)
+
+    def close(self):
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    import mididevices
+    if len(sys.argv) > 3 or sys.argv[1:2] in (['-h'], ['--help']):
+        print('usage: netreceiver.py [port [backend]]')
+        sys.exit(1)
+    device = mididevices.open(*sys.argv[2:3])
+    receiver = Receiver(device, *[int(arg) for arg in sys.argv[1:2]])
+    try:
+        receiver.serve()
+    except KeyboardInterrupt:
+        pass
+    print('%d datagrams, %d messages, %d lost, %d late' % (
+        receiver.packets, receiver.messages, receiver.lost, receiver.late))
+    device.close()
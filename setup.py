@@ -10,6 +10,8 @@ setup(
     app=['mplay.py'],
     data_files=['mixer.ppm'],
     options={'py2app': {'argv_emulation': True,
+                        # backends are imported by name, see mididevices
+                        'includes': ['mididevices', 'darwinmidi'],
                         'iconfile': 'mplay.icns',
                         'plist': {'CFBundleIdentifier': 'de.josefheinen.mplay',
                                   'CFBundleVersion': '1.0.1',
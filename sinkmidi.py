@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+from time import time
+
+import mididevices
+
+
+class midiDevice:
+    """Records (time, message) pairs instead of playing them.
+
+    Times are taken from `clock` (real time by default), or are the
+    timestamps passed to midievents(). If `path` is given, the log is
+    also written there, one message per line.
+    """
+
+    batch = True
+    timestamps = True
+    sysex = True
+    ports = 1
+
+    def __init__(self, clock=None, path=None):
+        if clock is None:
+            from smf import Clock
+            clock = Clock()
+        self.clock = clock
+        self.log = []
+        self.file = open(path, 'w') if path else None
+
+    def record(self, at, buf):
+        self.log.append((at, bytes(bytearray(buf))))
+        if self.file:
+            self.file.write('%.6f %s\n' % (at, ' '.join(
+                '%02x' % byte for byte in bytearray(buf))))
+
+    def midievent(self, buf):
+        self.record(self.clock.time(), buf)
+
+    def midievents(self, events):
+        for stamp, buf in events:
+            self.record(stamp, buf)
+
+    def mididataset1(self, address, data):
+        self.midievent(mididevices.dataset1(address, data))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def throughput(path):
+    """Times parsing and rendering `path`.
+
+    Runs the compiled loops if csmf is built; set MPLAY_PURE to time the
+    pure Python ones instead.
+    """
+    import smf
+
+    print('%s code' % ('compiled' if smf.csmf else 'pure Python'))
+    smf.cache = False
+    elapsed = []
+    for run in range(5):
+        start = time()
+        midi = smf.read(path)
+        elapsed.append(time() - start)
+    print('%-8s %7d events  %6.2f s  %8.0f events/s' % (
+        'parse', len(midi.ev), min(elapsed), len(midi.ev) / min(elapsed)))
+    for name, setup in (
+            ('plain', lambda midi: None),
+            ('shifted', lambda midi: midi.setsong(shift=+2)),
+            ('muted', lambda midi: [midi.setchannel(channel, muted=True)
+                                    for channel in range(0, 16, 2)])):
+        midi = smf.read(path)
+        setup(midi)
+        start = time()
+        log = smf.render(midi)
+        elapsed = time() - start
+        print('%-8s %7d events %7d messages  %6.2f s  %8.0f events/s  '
+              '(%.0fx real time)' % (
+                  name, len(midi.ev), len(log), elapsed,
+                  len(midi.ev) / elapsed, midi.clock.time() / elapsed))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: sinkmidi.py file')
+        sys.exit(1)
+    throughput(sys.argv[1])
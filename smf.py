@@ -4,18 +4,36 @@ from __future__ import absolute_import, division, print_function
 
 import sys
 import os
-from time import time, sleep
+import mmap
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import heapify, heappop, heapreplace, merge
+from operator import itemgetter
+from time import sleep
 
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import time as clock
 
-if sys.platform == 'darwin':
-    from darwinmidi import midiDevice
-elif sys.platform == 'win32':
-    from win32midi import midiDevice
-elif sys.platform == 'linux2':
-    from linux2midi import midiDevice
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+import smfcache
+
+# the compiled loops from csmf.pyx, if built (see csetup.py)
+csmf = None
+if not os.environ.get('MPLAY_PURE'):
+    try:
+        import csmf
+    except ImportError:
+        pass
 
 debug = False
 gm1 = True
+cache = True
 
 instruments = (
     'Piano 1', 'Piano 2', 'Piano 3', 'Honky-tonk',
@@ -115,6 +133,30 @@ chords = {
     0b000010001101: 'm9',
     0b000010101001: 'm11'}
 
+
+def chord(keys_pressed):
+    """Name the chord formed by a 12-bit pitch class mask.
+
+    Returns (root, name, text, notes) or None if the mask is no chord.
+    """
+    if bin(keys_pressed).count("1") in [3, 4, 5]:
+        for key in range(12):
+            if keys_pressed in chords:
+                text = '%-10s' % (notes[key] + chords[keys_pressed] + '   ')
+                pitches = []
+                for note in range(12):
+                    if keys_pressed & (1 << note):
+                        text += '  %s' % notes[(key + note) % 12]
+                        pitches.append(60 + key + note)
+                return key, chords[keys_pressed], '%-50s' % text, pitches
+            if keys_pressed & 1:
+                keys_pressed |= (1 << 12)
+            keys_pressed = (keys_pressed >> 1) & 0xfff
+    return None
+
+# chord() for every pitch class mask
+chordtable = [chord(keys_pressed) for keys_pressed in range(1 << 12)]
+
 messages = (
     'Note Off', 'Note  On', 'Key Pressure', 'Control Change',
     'Program Change', 'Channel Pressure', 'Pitch Wheel')
@@ -123,6 +165,24 @@ meta = (
     'Sequence Number', 'Text', 'Copyright', 'Sequence Name',
     'Instrument', 'Lyric', 'Marker', 'Cue Point')
 
+# playback program opcodes
+NOP, SEND, NOTEOFF, NOTEON, CONTROL, PROGRAM, META = range(7)
+
+opcodes = {0x80: NOTEOFF, 0x90: NOTEON, 0xb0: CONTROL, 0xc0: PROGRAM}
+
+controllers = {0: 'variation', 7: 'level', 10: 'pan', 91: 'reverb',
+               93: 'chorus', 94: 'delay'}
+
+# the order a seek restores controllers in: bank select before the
+# program change and the rest after it. Channel mode messages (120-127)
+# and data increments are events rather than state and are left out;
+# data entry is kept for each parameter number (RPN/NRPN) it was for
+banks = (0, 32)
+selects = ((101, 100), (99, 98))  # RPN, NRPN: most and least significant
+settings = tuple(controller for controller in range(120)
+                 if controller not in (0, 32, 6, 38, 96, 97, 98, 99, 100,
+                                       101))
+
 
 def dbg(message):
     print(message)
@@ -142,16 +202,713 @@ def printable(chars):
     return result
 
 
+def number(mf, off):
+    value = 0
+    while True:
+        byte = mf[off]
+        off += 1
+        value = (value << 7) + (byte & 0x7f)
+        if not byte & 0x80:
+            return value, off
+
+
+def decode(mf, off, end, ev, at=0, status=0, limit=0):
+    if csmf is not None and not debug:
+        return csmf.decode(mf, off, end, ev, at, status, limit, pydecode)
+    return pydecode(mf, off, end, ev, at, status, limit)
+
+
+def pydecode(mf, off, end, ev, at=0, status=0, limit=0):
+    # channel messages are appended straight to the columns; meta and
+    # system exclusive events take the general path below
+    ticks = ev.tick
+    tick = ticks.append
+    message = ev.status.append
+    data1 = ev.data1.append
+    data2 = ev.data2.append
+    trace = debug
+    while off < end:
+        delta = mf[off]
+        off += 1
+        if delta & 0x80:
+            delta, off = number(mf, off - 1)
+        at += delta
+        me = mf[off]
+        off += 1
+        if me < 0xf0:
+            if me & 0x80:
+                status = me
+                byte1 = mf[off] & 0x7f
+                off += 1
+            else:
+                byte1 = me
+            if status < 0xf0:
+                if status & 0xe0 == 0xc0:
+                    byte2 = 0
+                else:
+                    byte2 = mf[off] & 0x7f
+                    off += 1
+                tick(at)
+                message(status | 0x80)
+                data1(byte1)
+                data2(byte2)
+                if trace:
+                    dbgevent(at, status | 0x80, byte1, byte2)
+            else:
+                print('Corrupt MIDI file')
+        elif me == 0xf0 or me == 0xf7:
+            num_bytes, off = number(mf, off)
+            off += num_bytes
+            if trace:
+                dbg('%06d System Exclusive (%d bytes)' % (at, num_bytes))
+        elif me == 0xff:
+            me_type = mf[off]
+            num_bytes, off = number(mf, off + 1)
+            if me_type <= 0x0f:
+                ev.appendmeta(at, me_type, mf, off, num_bytes)
+                if trace and me_type < 8:
+                    dbg('%06d %s: %s' % (at, meta[me_type],
+                                         printable(mf[off: off + num_bytes])))
+            elif me_type == 0x20:
+                ev.appendmeta(at, me_type, mf, off, 1)
+                if trace:
+                    dbg('%06d Channel Prefix 0x%02x' % (at, mf[off]))
+            elif me_type == 0x21:
+                ev.appendmeta(at, me_type, mf, off, 1)
+                if trace:
+                    dbg('%06d Port Number 0x%02x' % (at, mf[off]))
+            elif me_type == 0x2f:
+                if trace:
+                    dbg('%06d End of Track' % at)
+                return off, at, None
+            elif me_type == 0x51:
+                ev.appendmeta(at, me_type, mf, off, 3)
+                if trace:
+                    data = mf[off: off + 3]
+                    tempo = (data[0] << 16) | (data[1] << 8) | data[2]
+                    dbg('%06d Tempo 0x%02x 0x%02x 0x%02x (%d, %d bpm)' %
+                        (at, data[0], data[1], data[2],
+                         tempo, 60000000 // tempo))
+            elif me_type == 0x58:
+                ev.appendmeta(at, me_type, mf, off, 4)
+                if trace:
+                    data = mf[off: off + 4]
+                    dbg('%06d Time 0x%02x 0x%02x 0x%02x 0x%02x' %
+                        (at, data[0], data[1], data[2], data[3]))
+            elif me_type == 0x59:
+                ev.appendmeta(at, me_type, mf, off, 2)
+                if trace:
+                    dbg('%06d Key 0x%02x 0x%02x' % (at, mf[off], mf[off + 1]))
+            elif trace:
+                dbg('%06d Meta Event 0x%02x (%d bytes)' %
+                    (at, me_type, num_bytes))
+            off += num_bytes
+        else:
+            status = me
+            off += 1
+            print('Corrupt MIDI file')
+        if limit and len(ticks) >= limit:
+            return off, at, status
+    return off, at, None
+
+
+def dbgevent(at, message, byte1, byte2):
+    state = (message >> 4) & 0x07
+    chan = message & 0x0f
+    if state in [0, 1]:
+        if chan != 9:
+            s = ' (%s%d)' % (notes[byte1 % 12], byte1 / 12)
+        else:
+            s = ' (%s)' % drum_instruments[byte1]
+    else:
+        s = ''
+    if state in [0, 1, 2, 3, 6]:
+        dbg('%06d %s 0x%02x 0x%02x 0x%02x%s' %
+            (at, messages[state], chan, byte1, byte2, s))
+    else:
+        dbg('%06d %s 0x%02x 0x%02x' % (at, messages[state], chan, byte1))
+
+
+def instruction(message, byte1, byte2):
+    me_type = message & 0xf0
+    if me_type == 0xc0:
+        return PROGRAM, bytearray((message, byte1))
+    if me_type == 0xb0 and byte1 == 32:
+        byte2 = 2
+    return opcodes.get(me_type, SEND), bytearray((message, byte1, byte2))
+
+
+def mapfile(path):
+    stream = open(path, 'rb')
+    mf = memoryview(mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ))
+    stream.close()
+    return mf
+
+
+def capacity(off, end):
+    # every event takes at least two bytes: delta time and one data byte
+    return (end - off) // 2 + 1
+
+
+def decodetrack(task):
+    from multiprocessing import shared_memory
+    path, name, base, off, end = task
+    mf = mapfile(path)
+    ev = EventStore(mf)
+    decode(mf, off, end, ev)
+    shm = shared_memory.SharedMemory(name)
+    ev.dump(shm.buf, base, capacity(off, end))
+    shm.close()
+    return len(ev), len(ev.offset)
+
+
+class EventStore:
+    columns = ('tick', 'status', 'data1', 'data2', 'offset', 'length')
+    itemsize = 18
+    # merge() sorts instead if its first `sample` blocks average fewer
+    # than `block` events, below which copying blocks is the slower way
+    sample = 512
+    block = 4
+
+    def __init__(self, pool=None):
+        self.tick = array('I')
+        self.status = array('B')
+        self.data1 = array('B')
+        self.data2 = array('I')  # data byte 2 or, for meta events, payload
+        self.offset = array('I')
+        self.length = array('I')
+        self.port = array('B')
+        self.pool = bytearray() if pool is None else pool
+
+    def __len__(self):
+        return len(self.tick)
+
+    def __getitem__(self, i):
+        if self.status[i] == 0xff:
+            return (self.tick[i], 0xff, self.data1[i],
+                    self.payload(self.data2[i]))
+        return self.tick[i], self.status[i], self.data1[i], self.data2[i]
+
+    def __iter__(self):
+        return self.events()
+
+    def events(self, start=0):
+        payload = self.payload
+        for ev in zip(memoryview(self.tick)[start:],
+                      memoryview(self.status)[start:],
+                      memoryview(self.data1)[start:],
+                      memoryview(self.data2)[start:]):
+            if ev[1] == 0xff:
+                yield ev[0], 0xff, ev[2], payload(ev[3])
+            else:
+                yield ev
+
+    def metaevents(self, me_type):
+        status = self.status.tobytes()
+        i = status.find(b'\xff')
+        while i >= 0:
+            if self.data1[i] == me_type:
+                yield self.tick[i], self.payload(self.data2[i])
+            i = status.find(b'\xff', i + 1)
+
+    def payload(self, n):
+        start = self.offset[n]
+        return self.pool[start: start + self.length[n]]
+
+    def append(self, at, message, byte1, byte2):
+        self.tick.append(at)
+        self.status.append(message)
+        self.data1.append(byte1)
+        self.data2.append(byte2)
+
+    def appendmeta(self, at, me_type, buf, off, n):
+        self.data2.append(len(self.offset))
+        if buf is self.pool:
+            self.offset.append(off)
+        else:
+            self.offset.append(len(self.pool))
+            self.pool += buf[off: off + n]
+        self.length.append(n)
+        self.tick.append(at)
+        self.status.append(0xff)
+        self.data1.append(me_type)
+
+    def route(self, runs):
+        # the port of each event: a Port Number meta event (0x21) sets
+        # it for the rest of its track. Channel Prefix (0x20) only tells
+        # which channel meta and system exclusive events of a track are
+        # about, so it does not change where messages go. The port
+        # numbers that carry other than meta events are numbered 0, 1, ...
+        # in order of first use, so a song on one port stays on channels
+        # 0-15 whatever its number
+        n = len(self.tick)
+        self.port = array('B', bytes(n))
+        status = self.status.tobytes()
+        segments = []
+        for start, end in zip(runs, runs[1:] + [n]):
+            number = 0
+            i = status.find(b'\xff', start, end)
+            while i >= 0:
+                if self.data1[i] == 0x21:
+                    data = self.payload(self.data2[i])
+                    if data:
+                        segments.append((start, i, number))
+                        start, number = i, data[0]
+                i = status.find(b'\xff', i + 1, end)
+            segments.append((start, end, number))
+        index = {}
+        for start, end, number in segments:
+            if number not in index and status[start:end].strip(b'\xff'):
+                index[number] = len(index)
+        for start, end, number in segments:
+            if index.get(number):
+                self.port[start:end] = array('B', [index[number]]) * \
+                    (end - start)
+
+    def ports(self):
+        return max(self.port) + 1 if len(self.port) else 1
+
+    def merge(self, runs):
+        # puts the runs, each in tick order, into one. Where tracks take
+        # turns in stretches, whole blocks are copied; if the first
+        # blocks show the tracks interleave closely, sorting is quicker
+        tick = self.tick
+        heap = [(tick[start], track, start, end)
+                for track, (start, end) in
+                enumerate(zip(runs, runs[1:] + [len(tick)]))
+                if start < end]
+        if len(heap) < 2:
+            return
+        heapify(heap)
+        blocks = []
+        done = 0
+        while len(heap) > 1:
+            at, track, start, end = heap[0]
+            if len(heap) == 2 or heap[1] < heap[2]:
+                at, other = heap[1][:2]
+            else:
+                at, other = heap[2][:2]
+            # on equal ticks the lower track goes first
+            if track < other:
+                stop = bisect_right(tick, at, start, end)
+            else:
+                stop = bisect_left(tick, at, start, end)
+            blocks.append((start, stop))
+            done += stop - start
+            if len(blocks) == self.sample and done < self.sample * self.block:
+                return self.sort()
+            if stop < end:
+                heapreplace(heap, (tick[stop], track, stop, end))
+            else:
+                heappop(heap)
+        blocks.append(heap[0][2:])
+        for column in ('tick', 'status', 'data1', 'data2', 'port'):
+            values = getattr(self, column)
+            merged = array(values.typecode)
+            for start, stop in blocks:
+                merged += values[start:stop]
+            setattr(self, column, merged)
+
+    def sort(self):
+        # a stable sort keeps events of equal tick in track order
+        order = itemgetter(*sorted(range(len(self.tick)),
+                                   key=self.tick.__getitem__))
+        for column in ('tick', 'status', 'data1', 'data2', 'port'):
+            values = getattr(self, column)
+            setattr(self, column, array(values.typecode, order(values)))
+
+    def dump(self, buf, base, capacity):
+        for column in self.columns:
+            values = getattr(self, column)
+            data = values.tobytes()
+            buf[base: base + len(data)] = data
+            base += capacity * values.itemsize
+
+    def extend(self, buf, base, capacity, n, m):
+        shift = len(self.offset)
+        start = len(self.tick)
+        for column in self.columns:
+            values = getattr(self, column)
+            count = n if column not in ('offset', 'length') else m
+            values.frombytes(buf[base: base + count * values.itemsize])
+            base += capacity * values.itemsize
+        if shift:
+            data2 = self.data2
+            status = self.status.tobytes()
+            i = status.find(b'\xff', start)
+            while i >= 0:
+                data2[i] += shift
+                i = status.find(b'\xff', i + 1)
+
+    def nbytes(self):
+        size = len(self.pool) if isinstance(self.pool, bytearray) else 0
+        for column in (self.tick, self.status, self.data1, self.data2,
+                       self.offset, self.length, self.port):
+            size += len(column) * column.itemsize
+        return size
+
+
+class EventStream:
+    def __init__(self, mf, chunks, window=64):
+        self.mf = mf
+        self.chunks = chunks
+        self.window = window
+        self.rewind()
+
+    def rewind(self):
+        self.it = merge(*[self.trackevents(off, end)
+                          for off, end in self.chunks], key=itemgetter(0))
+        self.pos = 0
+        self.head = next(self.it, None)
+
+    def trackevents(self, off, end):
+        at = status = 0
+        while status is not None:
+            ev = EventStore(self.mf)
+            off, at, status = decode(self.mf, off, end, ev, at, status,
+                                     self.window)
+            for event in ev:
+                yield event
+
+    def __iter__(self):
+        return self.events()
+
+    def events(self, start=0):
+        # the last event handed out stays at self.pos until it is
+        # asked for again, so play() can resume where it returned
+        if start < self.pos:
+            self.rewind()
+        while self.head is not None:
+            if self.pos >= start:
+                yield self.head
+            self.head = next(self.it, None)
+            self.pos += 1
+
+
+class TempoMap:
+    def __init__(self, division, tempo=500000):
+        self.division = division
+        self.at = array('I', [0])
+        self.tempo = array('I', [int(tempo)])
+        self.usecs = array('d', [0])
+
+    def append(self, at, tempo):
+        last = len(self.at) - 1
+        if at == self.at[last]:
+            self.tempo[last] = tempo
+        elif at > self.at[last] and tempo != self.tempo[last]:
+            self.usecs.append(self.usecs[last] + (at - self.at[last]) *
+                              self.tempo[last] / self.division)
+            self.at.append(at)
+            self.tempo.append(tempo)
+
+    def tempoat(self, at):
+        return self.tempo[bisect_right(self.at, at) - 1]
+
+    def seconds(self, at):
+        i = bisect_right(self.at, at) - 1
+        return (self.usecs[i] + (at - self.at[i]) * self.tempo[i] /
+                self.division) / 1000000
+
+    def ticks(self, seconds):
+        usecs = seconds * 1000000
+        i = max(bisect_right(self.usecs, usecs) - 1, 0)
+        return self.at[i] + (usecs - self.usecs[i]) * self.division / \
+            self.tempo[i]
+
+
+class Clock:
+    def time(self):
+        return clock()
+
+    def sleep(self, seconds):
+        sleep(seconds)
+
+
+class VirtualClock:
+    """A clock that only advances when slept on, for offline rendering."""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # always advance, or rounding could leave a wait unfinished
+        self.now += max(seconds, 1e-9)
+
+
+class SongState:
+    # channels are numbered port << 4 | channel
+    def __init__(self, ports=1):
+        self.program = array('b', [-1] * 16 * ports)
+        self.control = array('b', [-1] * 16 * ports * 128)
+        self.bend = array('h', [-1] * 16 * ports)
+        # 0 if an RPN was selected last, 1 for an NRPN
+        self.selected = array('b', [-1] * 16 * ports)
+        # (channel, kind, msb, lsb): (data entry msb, lsb)
+        self.entry = {}
+        self.meta = {}
+
+    def copy(self):
+        state = SongState(len(self.program) // 16)
+        state.program[:] = self.program
+        state.control[:] = self.control
+        state.bend[:] = self.bend
+        state.selected[:] = self.selected
+        state.entry.update(self.entry)
+        state.meta.update(self.meta)
+        return state
+
+    def update(self, message, byte1, byte2, port=0):
+        me_type = message & 0xf0
+        if message == 0xff:
+            if byte1 in (0x51, 0x58, 0x59):
+                self.meta[byte1] = byte2
+        elif me_type == 0xb0:
+            if byte1 < 120:
+                channel = port << 4 | message & 0x0f
+                self.control[channel << 7 | byte1] = byte2
+                if byte1 == 6 or byte1 == 38:
+                    kind = self.selected[channel]
+                    if kind >= 0:
+                        msb, lsb = selects[kind]
+                        key = (channel, kind, self.control[channel << 7 | msb],
+                               self.control[channel << 7 | lsb])
+                        coarse, fine = self.entry.get(key, (-1, -1))
+                        if byte1 == 6:
+                            self.entry[key] = (byte2, fine)
+                        else:
+                            self.entry[key] = (coarse, byte2)
+                elif 98 <= byte1 <= 101:
+                    self.selected[channel] = 1 if byte1 < 100 else 0
+        elif me_type == 0xc0:
+            self.program[port << 4 | message & 0x0f] = byte1
+        elif me_type == 0xe0:
+            self.bend[port << 4 | message & 0x0f] = byte2 << 7 | byte1
+
+    def messages(self, used=()):
+        # (port, message, byte1, byte2) restoring the state. Channels in
+        # `used` may hold values set later in the song, so what is unset
+        # here goes back to its default: Reset All Controllers, then
+        # bank, program, the controllers it leaves alone and the bend
+        defaults = dict((controller, dict(Mixer.fields)[field])
+                        for controller, field in controllers.items())
+        entries = sorted(self.entry.items())
+        for channel in range(len(self.program)):
+            port = channel >> 4
+            status = channel & 0x0f
+            control = self.control[channel << 7: (channel + 1) << 7]
+            reset = channel < len(used) and used[channel]
+            if reset:
+                yield port, 0xb0 | status, 121, 0
+            for controller in banks:
+                if control[controller] >= 0:
+                    yield port, 0xb0 | status, controller, control[controller]
+                elif reset:
+                    yield port, 0xb0 | status, controller, 0
+            if self.program[channel] >= 0:
+                yield port, 0xc0 | status, self.program[channel], 0
+            elif reset:
+                yield port, 0xc0 | status, 0, 0
+            for controller in settings:
+                if control[controller] >= 0:
+                    yield port, 0xb0 | status, controller, control[controller]
+                elif reset and controller in defaults:
+                    yield port, 0xb0 | status, controller, defaults[controller]
+            # the data entered for each parameter, then the parameter
+            # selected last, for increments and data entry to come
+            for (ch, kind, msb, lsb), (coarse, fine) in entries:
+                if ch == channel:
+                    for controller, value in zip(selects[kind], (msb, lsb)):
+                        if value >= 0:
+                            yield port, 0xb0 | status, controller, value
+                    if coarse >= 0:
+                        yield port, 0xb0 | status, 6, coarse
+                    if fine >= 0:
+                        yield port, 0xb0 | status, 38, fine
+            kind = self.selected[channel]
+            for pair in (selects[1 - kind], selects[kind]) if kind >= 0 \
+                    else selects:
+                for controller in pair:
+                    if control[controller] >= 0:
+                        yield (port, 0xb0 | status, controller,
+                               control[controller])
+            if self.bend[channel] >= 0:
+                yield (port, 0xe0 | status, self.bend[channel] & 0x7f,
+                       self.bend[channel] >> 7)
+            elif reset:
+                yield port, 0xe0 | status, 0, 0x40
+
+
+class Checkpoints:
+    def __init__(self, ports=1):
+        self.at = array('I', [0])
+        self.index = array('I', [0])
+        self.states = [SongState(ports)]
+
+    def append(self, at, index, state):
+        self.at.append(at)
+        self.index.append(index)
+        self.states.append(state.copy())
+
+    def find(self, at):
+        k = max(bisect_right(self.at, at) - 1, 0)
+        return self.index[k], self.states[k].copy()
+
+
+class Timeline:
+    """Values over the song, each holding from its time in seconds on."""
+
+    def __init__(self, value=None):
+        self.at = array('d', [0])
+        self.values = [value]
+
+    def __len__(self):
+        return len(self.at)
+
+    def append(self, at, value):
+        if at == self.at[-1]:
+            self.values[-1] = value
+        elif value != self.values[-1]:
+            self.at.append(at)
+            self.values.append(value)
+
+    def find(self, at):
+        return self.values[max(bisect_right(self.at, at) - 1, 0)]
+
+
+class Mixer:
+    """The state of all channels, one list per field.
+
+    There are 16 channels per port, channel `c` of port `p` being entry
+    p << 4 | c. copy() takes a snapshot of the whole mixer; channelinfo()
+    hands out a ChannelView mapping instead.
+    """
+
+    fields = (('used', False), ('muted', False), ('name', ''),
+              ('instrument', 0), ('family', ''), ('variation', 0),
+              ('level', 100), ('pan', 64), ('reverb', 40), ('chorus', 0),
+              ('delay', 0), ('sense', 64), ('shift', 64), ('velocity', 0),
+              ('intensity', 0))
+    __slots__ = tuple(field for field, value in fields) + (
+        'notes', 'controls')
+
+    def __init__(self, ports=1):
+        for field, value in self.fields:
+            setattr(self, field, [value] * 16 * ports)
+        self.notes = [[] for channel in range(16 * ports)]
+        self.link()
+
+    def link(self):
+        # the lists control changes update, by controller number
+        self.controls = dict((controller, getattr(self, field))
+                             for controller, field in controllers.items())
+
+    def copy(self):
+        mixer = Mixer.__new__(Mixer)
+        for field, value in self.fields:
+            setattr(mixer, field, getattr(self, field)[:])
+        mixer.notes = [notes[:] for notes in self.notes]
+        mixer.link()
+        return mixer
+
+    def decay(self, step):
+        intensity = self.intensity
+        for channel in range(len(intensity)):
+            intensity[channel] = max(intensity[channel] - step, 0)
+
+
+class ChannelView(Mapping):
+    """A read-only dict-like view of one channel of a Mixer."""
+
+    names = tuple(field for field, value in Mixer.fields) + ('notes',)
+
+    def __init__(self, mixer, channel):
+        self.mixer = mixer
+        self.channel = channel
+
+    def __getitem__(self, key):
+        if key not in self.names:
+            raise KeyError(key)
+        return getattr(self.mixer, key)[self.channel]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+class Program:
+    """Events compiled for playback.
+
+    Each event becomes its time in seconds, an opcode telling how it
+    updates the channel state and the bytes to send, so the play loop
+    no longer converts ticks or builds messages. Identical messages
+    share one buffer. `port` gives the port of each event, or is None
+    if all go to the first.
+    """
+
+    def __init__(self, ev, tempomap):
+        self.time = array('d')
+        ticks = ev.tick
+        at = tempomap.at
+        lo = 0
+        for k in range(len(at)):
+            if k + 1 < len(at):
+                hi = bisect_left(ticks, at[k + 1], lo)
+            else:
+                hi = len(ticks)
+            usecs = tempomap.usecs[k]
+            tempo = tempomap.tempo[k]
+            self.time.extend([(usecs + (tick - at[k]) * tempo /
+                               tempomap.division) / 1000000
+                              for tick in ticks[lo:hi]])
+            lo = hi
+        table = bytearray(SEND for status in range(256))
+        for status in range(0x80, 0xf0):
+            table[status] = opcodes.get(status & 0xf0, SEND)
+        table[0xff] = NOP
+        status = ev.status.tobytes()
+        self.opcode = array('B', status.translate(table))
+        keys = [message << 16 | byte1 << 8 | byte2 for message, byte1, byte2
+                in zip(ev.status, ev.data1, ev.data2)]
+        compiled = {}
+        for key in set(keys):
+            if key >> 16 != 0xff:
+                compiled[key] = instruction(key >> 16, key >> 8 & 0xff,
+                                            key & 0xff)[1]
+        self.message = list(map(compiled.get, keys))
+        self.port = ev.port if ev.port.tobytes().strip(b'\0') else None
+        i = status.find(b'\xff')
+        while i >= 0:
+            if ev.data1[i] in (0x51, 0x58, 0x59):
+                self.opcode[i] = META
+            self.message[i] = ev.payload(ev.data2[i])
+            i = status.find(b'\xff', i + 1)
+
+    def __len__(self):
+        return len(self.time)
+
+
 class SMF:
     def __init__(self):
         self.path = None
         self.device = None
+        # the devices played to, the one each port goes to and the
+        # running status sent to each
+        self.devices = []
+        self.outputs = [0]
+        self.running = [0]
+        self.routed = False  # True with more than one device
+        self.status = 0
         self.format = 0
         self.tracks = 0
         self.mf = bytearray(0)
         self.off = 0
-        self.ev = []
-        self.status = 0
+        self.ev = EventStore()
         self.midi_clock = 0
         self.next = 0
         self.start = None
@@ -163,31 +920,43 @@ class SMF:
         self.line = self.text = ''
         self.chord = ''
         self.notes = []
+        self.keys_pressed = 0
         self.tempo = 60000000 / self.bpm
+        self.tempomap = TempoMap(self.division, self.tempo)
+        self.chordmap = self.lyricmap = None
+        self.program = None
+        self.clock = Clock()
+        self.speed = 1.0
+        self.gain = 1.0
+        self.lookahead = 0
+        self.timestamps = False
+        self.batch = None
+        self.batches = []
+        self.stamp = self.scheduled = 0
         self.numerator = self.denominator = 4
         self.clocks_per_beat = 24
         self.notes_per_quarter = 8
         self.key = 8
         self.key_shift = 0
         self.mode = 2
-        self.channel = []
-        for ch in range(16):
-            self.channel.append({'used': False,
-                                 'muted': False,
-                                 'name': '',
-                                 'instrument': 0,
-                                 'family': '',
-                                 'variation': 0,
-                                 'level': 100,
-                                 'pan': 64,
-                                 'reverb': 40,
-                                 'chorus': 0,
-                                 'delay': 0,
-                                 'sense': 64,
-                                 'shift': 64,
-                                 'velocity': 0,
-                                 'intensity': 0,
-                                 'notes': []})
+        self.ports = 1
+        self.port = 0  # of the message being played
+        self.layout()
+
+    def layout(self):
+        # sizes the channel state for the ports the song uses
+        self.mixer = Mixer(self.ports)
+        self.channel = [ChannelView(self.mixer, ch)
+                        for ch in range(16 * self.ports)]
+        self.checkpoints = Checkpoints(self.ports)
+        # how often each note is held per channel (indexed by channel << 8
+        # | note), and per pitch class over the channels chordinfo looks at.
+        # Pitch classes are only counted while there is no chordmap
+        self.held = [0] * (16 * self.ports << 8)
+        self.chordal = array('B', [1]) * 16 * self.ports
+        for channel in range(9, 16 * self.ports, 16):
+            self.chordal[channel] = 0
+        self.pitches = [0] * 12
 
     def bytes(self, n):
         return self.mf[self.off: self.off + n]
@@ -209,6 +978,10 @@ class SMF:
         self.off += 2
         return value
 
+    def extractlong(self):
+        value = (self.extractshort() << 16) + self.extractshort()
+        return value
+
     def extractnumber(self):
         value = 0
         if self.mf[self.off] & 0x80:
@@ -223,129 +996,192 @@ class SMF:
         self.off += 1
         return value
 
-    def readevents(self):
-        state = 0
-        at = 0
-        while True:
-            delta = self.extractnumber()
-            at += delta
-            me = self.extractbyte()
-            if me == 0xf0 or me == 0xf7:
-                num_bytes = self.extractnumber()
-                self.off += num_bytes
-                if debug:
-                    dbg('%06d System Exclusive (%d bytes)' % (at, num_bytes))
-            elif me == 0xff:
-                me_type = self.extractbyte()
-                num_bytes = self.extractnumber()
-                if me_type < 8:
-                    text = self.extractbytes(num_bytes)
-                    self.ev.append([at, me, me_type, text])
-                    if debug:
-                        dbg('%06d %s: %s' % (at, meta[me_type],
-                                             printable(text)))
-                elif me_type <= 0x0f:
-                    self.ev.append(
-                        [at, me, me_type, self.extractbytes(num_bytes)])
-                elif me_type == 0x20:
-                    byte1 = self.extractbyte()
-                    self.ev.append([at, me, me_type, byte1])
-                    if debug:
-                        dbg('%06d Channel Prefix 0x%02x' % (at, byte1))
-                elif me_type == 0x21:
-                    byte1 = self.extractbyte()
-                    self.ev.append([at, me, me_type, byte1])
-                    if debug:
-                        dbg('%06d Port Number 0x%02x' % (at, byte1))
-                elif me_type == 0x2f:
-                    if debug:
-                        dbg('%06d End of Track' % at)
-                    return
-                elif me_type == 0x51:
-                    data = self.extractbytes(3)
-                    self.ev.append([at, me, me_type, data])
-                    if debug:
-                        tempo = (data[0] << 16) | (data[1] << 8) | data[2]
-                        dbg('%06d Tempo 0x%02x 0x%02x 0x%02x (%d, %d bpm)' %
-                            (at, data[0], data[1], data[2],
-                             tempo, 60000000 // tempo))
-                elif me_type == 0x58:
-                    data = self.extractbytes(4)
-                    self.ev.append([at, me, me_type, data])
-                    if debug:
-                        dbg('%06d Time 0x%02x 0x%02x 0x%02x 0x%02x' %
-                            (at, data[0], data[1], data[2], data[3]))
-                elif me_type == 0x59:
-                    data = self.extractbytes(2)
-                    self.ev.append([at, me, me_type, data])
-                    if debug:
-                        dbg('%06d Key 0x%02x 0x%02x' % (at, data[0], data[1]))
-                else:
-                    self.off += num_bytes
-                    if debug:
-                        dbg('%06d Meta Event 0x%02x (%d bytes)' %
-                            (at, me_type, num_bytes))
-            else:
-                byte1 = me
-                if byte1 & 0x80:
-                    chan = byte1 & 0x0f
-                    state = (byte1 >> 4) & 0x07
-                    byte1 = self.extractbyte() & 0x7f
-                if state < 7:
-                    message = 0x80 | (state << 4) | chan
-                    if state != 4 and state != 5:
-                        byte2 = self.extractbyte() & 0x7f
-                    else:
-                        byte2 = 0
-                    self.ev.append([at, message, byte1, byte2])
-                    if debug:
-                        if state in [0, 1]:
-                            if chan != 9:
-                                s = ' (%s%d)' % (notes[byte1 % 12], byte1 / 12)
-                            else:
-                                s = ' (%s)' % drum_instruments[byte1]
-                        else:
-                            s = ''
-                        if state in [0, 1, 2, 3, 6]:
-                            dbg('%06d %s 0x%02x 0x%02x 0x%02x%s' %
-                                (at, messages[state], chan, byte1, byte2, s))
-                        else:
-                            dbg('%06d %s 0x%02x 0x%02x' %
-                                (at, messages[state], chan, byte1))
-                else:
-                    print('Corrupt MIDI file')
+    def readevents(self, end=None):
+        if end is None:
+            end = len(self.mf)
+        self.off = decode(self.mf, self.off, end, self.ev)[0]
 
-    def read(self, path):
+    def read(self, path, mapped=False, streaming=False, workers=0):
         self.path = os.path.basename(path)
-        stream = open(path, 'rb')
-        self.mf = bytearray(stream.read())
+        # an empty file cannot be mapped, so it is always read
+        if (mapped or streaming or workers > 1) and os.path.getsize(path):
+            self.mf = mapfile(path)
+            self.ev = EventStore(self.mf)
+        else:
+            stream = open(path, 'rb')
+            self.mf = bytearray(stream.read())
+            stream.close()
+        cached = cache and not (mapped or streaming or workers > 1)
+        if cached and smfcache.load(self, self.mf):
+            self.ports = self.ev.ports()
+            self.layout()
+            self.checkpoint()
+            self.analyze()
+            return
         if self.bytes(4) == b'MThd':
-            self.off += 8
+            self.off += 4
+            end = self.extractlong()
+            end += self.off
             self.format = self.extractshort()
             self.tracks = self.extractshort()
             self.division = self.extractshort()
+            self.off = end
+        self.tempomap = TempoMap(self.division, self.tempo)
         if debug:
             dbg('Format: %d, Tracks: %d, Division: %d' %
                 (self.format, self.tracks, self.division))
-        for track in range(self.tracks):
-            if self.bytes(4) == b'MTrk':
-                self.off += 8
-                self.readevents()
-            else:
+        chunks = []
+        while len(chunks) < self.tracks:
+            if self.off + 8 > len(self.mf):
                 print('Missing track')
-        stream.close()
-        self.ev = sorted(self.ev, key=lambda tup: tup[0])
-        self.playing_time = 0
-        at = start = 0
-        tempo = self.tempo
-        for ev in self.ev:
-            (at, message, me_type, data) = ev
-            if message == 0xff and me_type == 0x51:
-                self.playing_time += (at - start) / self.division * \
-                    tempo / 1000
-                start = at
-                tempo = (data[0] << 16) | (data[1] << 8) | data[2]
-        self.playing_time += (at - start) / self.division * tempo / 1000
+                break
+            chunk = self.bytes(4)
+            self.off += 4
+            end = self.extractlong()
+            end += self.off
+            if chunk == b'MTrk':
+                chunks.append((self.off, end))
+            self.off = end
+        if streaming:
+            self.ev = EventStream(self.mf, chunks)
+            return
+        if workers > 1 and len(chunks) > 1:
+            runs = self.readparallel(path, chunks, workers)
+        else:
+            runs = []
+            for off, end in chunks:
+                runs.append(len(self.ev))
+                self.off = off
+                self.readevents(end)
+        self.ev.route(runs)
+        self.ev.merge(runs)
+        self.ports = self.ev.ports()
+        self.layout()
+        if debug:
+            dbg('Events: %d (%.1f bytes/event)' %
+                (len(self.ev), self.ev.nbytes() / max(len(self.ev), 1)))
+        for at, data in self.ev.metaevents(0x51):
+            self.tempomap.append(at, (data[0] << 16) | (data[1] << 8) |
+                                 data[2])
+        if len(self.ev):
+            self.playing_time = self.tempomap.seconds(self.ev.tick[-1]) * 1000
+        self.checkpoint()
+        self.analyze()
+        if cached:
+            smfcache.save(self, self.mf)
+
+    def readparallel(self, path, chunks, workers):
+        from multiprocessing import Pool, shared_memory
+        bases = [0]
+        for off, end in chunks:
+            bases.append(bases[-1] + capacity(off, end) * EventStore.itemsize)
+        shm = shared_memory.SharedMemory(create=True, size=bases[-1])
+        try:
+            pool = Pool(workers)
+            try:
+                counts = pool.map(decodetrack, [
+                    (path, shm.name, base, off, end)
+                    for base, (off, end) in zip(bases, chunks)])
+            finally:
+                pool.close()
+                pool.join()
+            runs = []
+            for base, (off, end), (n, m) in zip(bases, chunks, counts):
+                runs.append(len(self.ev))
+                self.ev.extend(shm.buf, base, capacity(off, end), n, m)
+        finally:
+            shm.close()
+            shm.unlink()
+        return runs
+
+    def checkpoint(self, interval=1024):
+        ev = self.ev
+        state = SongState(self.ports)
+        bar = self.division * 4
+        next_bar = bar
+        last = 0
+        for index, at, message, byte1, byte2, port in zip(
+                range(len(ev)), ev.tick, ev.status, ev.data1, ev.data2,
+                ev.port):
+            if at >= next_bar or index - last >= interval:
+                self.checkpoints.append(at, index, state)
+                while next_bar <= at:
+                    next_bar += bar
+                last = index
+            if message >= 0xb0 and message & 0xf0 != 0xd0:
+                if message == 0xff:
+                    if byte1 != 0x51 and byte1 != 0x58 and byte1 != 0x59:
+                        continue
+                    byte2 = ev.payload(byte2)
+                    if byte1 == 0x58:
+                        bar = max(self.division * 4 * byte2[0] >> byte2[1],
+                                  1)
+                state.update(message, byte1, byte2, port)
+
+    def analyze(self):
+        # the chords (as pitch class masks) and lyric lines of the whole
+        # song by time, so the play loop needs not assemble them and they
+        # can be looked up for any position
+        ev = self.ev
+        seconds = self.tempomap.seconds
+        self.chordmap = Timeline(0)
+        self.lyricmap = Timeline('')
+        held = [0] * (16 * self.ports << 8)
+        chordal = [channel & 0x0f != 9 for channel in range(16 * self.ports)]
+        pitches = [0] * 12
+        keys_pressed = last = 0
+        line = ''
+        for at, message, byte1, byte2, port in zip(ev.tick, ev.status,
+                                                   ev.data1, ev.data2,
+                                                   ev.port):
+            if at != last:
+                if chordtable[keys_pressed]:
+                    self.chordmap.append(seconds(last), keys_pressed)
+                last = at
+            me_type = message & 0xf0
+            channel = port << 4 | message & 0x0f
+            if me_type == 0x90 or me_type == 0x80:
+                key = channel << 8 | byte1
+                if me_type == 0x80 or byte2 == 0:
+                    if held[key]:
+                        held[key] -= 1
+                        if not held[key] and chordal[channel]:
+                            pitches[byte1 % 12] -= 1
+                            if not pitches[byte1 % 12]:
+                                keys_pressed &= ~(1 << byte1 % 12)
+                else:
+                    if not held[key] and chordal[channel]:
+                        pitches[byte1 % 12] += 1
+                        keys_pressed |= 1 << byte1 % 12
+                    held[key] += 1
+            elif me_type == 0xc0:
+                bass = families[byte1 // 8] == 'Bass'
+                if channel & 0x0f != 9 and chordal[channel] == bass:
+                    chordal[channel] = not bass
+                    for note in range(128):
+                        if held[channel << 8 | note]:
+                            pitches[note % 12] += -1 if bass else 1
+                    keys_pressed = 0
+                    for pitch, count in enumerate(pitches):
+                        if count:
+                            keys_pressed |= 1 << pitch
+            elif message == 0xff and byte1 == 0x05:
+                data = ev.payload(byte2)
+                if not data:
+                    continue
+                if data[0] in [13, 10]:
+                    line = ''
+                elif data[-1] in [13, 10]:
+                    self.lyricmap.append(seconds(at),
+                                         line + printable(data[:-1]))
+                    line = ''
+                else:
+                    line += printable(data)
+                    self.lyricmap.append(seconds(at), line)
+        if chordtable[keys_pressed]:
+            self.chordmap.append(seconds(last), keys_pressed)
+        # chordinfo() has the chordmap now, so playing need not count
+        self.chordal = array('B', bytes(16 * self.ports))
 
     def fileinfo(self):
         hsecs = self.playing_time // 10
@@ -360,12 +1196,17 @@ class SMF:
                 keys[self.key + 7], modes[self.mode],
                 self.key_shift)
 
-    def songinfo(self):
+    def position(self):
+        if not self.start:
+            return 0
         if self.pause != 0:
-            now = (self.pause - self.elapsed_time) * 1000
-        else:
-            now = (time() - self.elapsed_time) * 1000
-        ticks = int(now * self.division * 1000 / self.tempo)
+            return (self.pause - self.elapsed_time) * self.speed
+        return (self.clock.time() - self.elapsed_time) * self.speed
+
+    def songinfo(self):
+        now = self.position()
+        ticks = int(self.tempomap.ticks(now))
+        now *= 1000
         hsecs = now / 10
         secs = hsecs / 100
         mins = secs / 60
@@ -382,37 +1223,33 @@ class SMF:
                 self.clocks_per_beat, self.notes_per_quarter)
 
     def beatinfo(self):
-        if self.pause != 0:
-            now = (self.pause - self.elapsed_time) * 1000
+        return int(self.tempomap.ticks(self.position()) / self.division)
+
+    def lyrics(self, at=None):
+        # `at` is a song position in seconds, later ones look ahead
+        if self.lyricmap is None:
+            return '%-80s' % self.text
+        if at is None:
+            at = self.position()
+        return '%-80s' % self.lyricmap.find(at)
+
+    def chordinfo(self, at=None):
+        if self.chordmap is None:
+            keys_pressed = 0
+            for pitch, count in enumerate(self.pitches):
+                if count:
+                    keys_pressed |= 1 << pitch
         else:
-            now = (time() - self.elapsed_time) * 1000
-        return int(now * 1000 / self.tempo)
-
-    def lyrics(self):
-        return '%-80s' % self.text
-
-    def chordinfo(self):
-        keys_pressed = 0
-        for channel in range(16):
-            info = self.channel[channel]
-            if channel != 9 and info['family'] != 'Bass':
-                for note in info['notes']:
-                    keys_pressed |= (1 << (note % 12))
-        if bin(keys_pressed).count("1") in [3, 4, 5]:
-            for key in range(12):
-                if keys_pressed in chords:
-                    self.chord = '%-10s' % (
-                        notes[key] + chords[keys_pressed] + '   ')
-                    self.notes = []
-                    for note in range(12):
-                        if keys_pressed & (1 << note):
-                            self.chord += '  %s' % notes[(key + note) % 12]
-                            self.notes.append(60 + key + note)
-                    self.chord = '%-50s' % self.chord
-                    break
-                if keys_pressed & 1:
-                    keys_pressed |= (1 << 12)
-                keys_pressed = (keys_pressed >> 1) & 0xfff
+            if at is None:
+                at = self.position()
+            keys_pressed = self.chordmap.find(at)
+            shift = self.key_shift % 12
+            keys_pressed = (keys_pressed << shift |
+                            keys_pressed >> (12 - shift)) & 0xfff
+        if keys_pressed != self.keys_pressed:
+            self.keys_pressed = keys_pressed
+            if chordtable[keys_pressed]:
+                root, name, self.chord, self.notes = chordtable[keys_pressed]
         return self.chord, self.notes
 
     def channelinfo(self, channel):
@@ -420,222 +1257,426 @@ class SMF:
 
     def writemidi(self, buf):
         start = 0
-        if not gm1 and buf[0] < 0xf0:
-            if buf[0] == self.status:
-                start += 1
+        if self.routed:
+            start = self.writeport(buf)
+        else:
+            if not gm1 and buf[0] < 0xf0:
+                if buf[0] == self.status:
+                    start += 1
+                else:
+                    self.status = buf[0]
+            if self.batch is not None:
+                self.batch.append((self.stamp, buf[start:]))
+            elif self.scheduled and self.scheduled > self.clock.time():
+                self.device.midievents([(self.scheduled, buf[start:])])
             else:
-                self.status = buf[0]
-        self.device.midievent(buf[start:])
+                self.device.midievent(buf[start:])
         if debug:
             s = sep = ''
             for byte in buf[start:]:
                 s += sep + '0x%02x' % byte
                 sep = ' '
-            print("%.3f %s" % (time() - self.start, s))
+            print("%.3f %s" % (self.clock.time() - self.start, s))
+
+    def writeport(self, buf):
+        # sends a channel message to the device of self.port and a
+        # system message to every device, keeping the running status of
+        # each; returns the number of status bytes left out
+        start = 0
+        if buf[0] < 0xf0:
+            output = self.outputs[self.port]
+            if not gm1:
+                if buf[0] == self.running[output]:
+                    start += 1
+                else:
+                    self.running[output] = buf[0]
+            outputs = (output,)
+        else:
+            outputs = range(len(self.devices))
+        for output in outputs:
+            batch = self.batches[output]
+            if batch is not None:
+                batch.append((self.stamp, buf[start:]))
+            elif self.scheduled and self.scheduled > self.clock.time():
+                self.devices[output].midievents([(self.scheduled,
+                                                  buf[start:])])
+            else:
+                self.devices[output].midievent(buf[start:])
+        return start
+
+    def flush(self):
+        for output, batch in enumerate(self.batches):
+            if batch:
+                self.devices[output].midievents(batch)
+                self.scheduled = max(self.scheduled, batch[-1][0])
+                del batch[:]
 
     def allnotesoff(self, channel):
-        for note in self.channel[channel]['notes']:
-            self.writemidi([0x80 + channel, note, 0])
-        self.channel[channel]['notes'] = []
+        notes = self.mixer.notes[channel]
+        self.port = channel >> 4
+        for note in notes:
+            self.writemidi([0x80 + (channel & 0x0f), note, 0])
+            self.held[channel << 8 | note & 0xff] = 0
+            if self.chordal[channel]:
+                self.pitches[note % 12] -= 1
+        del notes[:]
 
     def songposition(self, beat):
-        self.next = 0
-        for ev in self.ev:
+        target = max(beat, 0) * self.division
+        self.next, state = self.checkpoints.find(target)
+        ports = getattr(self.ev, 'port', None)
+        for ev in self.ev.events(self.next):
             (at, message, byte1, byte2) = ev
-            if at > beat * self.division:
-                self.elapsed_time = time() - at / self.division / 1000000.0 * \
-                    self.tempo
+            if at > target:
+                self.elapsed_time = self.clock.time() - \
+                    self.tempomap.seconds(at) / self.speed
                 break
+            if message == 0xff and byte1 == 0x51:
+                self.tempomap.append(at, (byte2[0] << 16) |
+                                     (byte2[1] << 8) | byte2[2])
+            state.update(message, byte1, byte2,
+                         ports[self.next] if ports else 0)
             self.next += 1
+        self.restore(state, target)
+
+    def restore(self, state, at):
+        for me_type in sorted(state.meta):
+            self.metaevent(at, me_type, state.meta[me_type])
+        if self.device is not None:
+            for port, message, byte1, byte2 in state.messages(
+                    self.mixer.used):
+                self.port = port
+                self.channelevent(message, byte1, byte2)
 
     def setsong(self, **info):
         if 'shift' in info:
-            for ch in range(16):
+            for ch in range(len(self.channel)):
                 self.allnotesoff(ch)
             self.key_shift += info['shift']
         elif 'bpm' in info:
+            if self.bpm + info['bpm'] <= 0:
+                return
+            now = self.pause if self.pause != 0 else self.clock.time()
+            speed = self.speed
+            self.speed *= (self.bpm + info['bpm']) / self.bpm
             self.bpm += info['bpm']
-            now = time()
-            tempo = self.tempo
-            self.tempo = 60000000 / self.bpm * 4 / self.denominator
             self.elapsed_time = now - (now - self.elapsed_time) * \
-                self.tempo / tempo
-        elif 'bar' in info:
-            now = (time() - self.elapsed_time) * 1000
-            beat = int(now * 1000 / self.tempo)
-            beat += 4 * info['bar'] - (beat % 4)
-            for ch in range(16):
+                speed / self.speed
+        elif 'bar' in info or 'beat' in info:
+            if 'beat' in info:
+                beat = max(info['beat'], 0)
+            else:
+                beat = self.beatinfo()
+                beat += 4 * info['bar'] - (beat % 4)
+            for ch in range(len(self.channel)):
                 self.allnotesoff(ch)
             self.songposition(beat)
             if self.pause != 0:
-                self.pause = time()
+                self.pause = self.clock.time()
         elif 'action' in info:
             if info['action'] == 'exit':
-                for ch in range(16):
+                for ch in range(len(self.channel)):
                     self.allnotesoff(ch)
-                self.device.close()
+                for device in self.devices:
+                    device.close()
             elif info['action'] == 'pause':
                 if self.pause == 0:
-                    self.pause = time()
+                    self.pause = self.clock.time()
                     self.writemidi([0xfc])
-                    for ch in range(16):
+                    for ch in range(len(self.channel)):
                         self.allnotesoff(ch)
                 else:
-                    self.elapsed_time += time() - self.pause
+                    self.elapsed_time += self.clock.time() - self.pause
                     self.pause = 0
                     self.writemidi([0xfb])
 
-    def setchannel(self, channel, **info):
+    def setchannel(self, channel, wait=True, **info):
+        # `channel` is port << 4 | channel, as in the mixer. Some changes
+        # need the synth to be left alone for a while; unless `wait`,
+        # that time is returned for the caller to wait instead
+        mixer = self.mixer
+        self.port = channel >> 4
+        status = channel & 0x0f
         if 'muted' in info:
-            self.channel[channel]['muted'] = info['muted']
+            mixer.muted[channel] = info['muted']
             if info['muted']:
                 self.allnotesoff(channel)
         elif 'solo' in info:
-            for ch in range(16):
-                self.channel[ch]['muted'] = True if ch != channel else False
-                if self.channel[ch]['muted']:
+            for ch in range(len(self.channel)):
+                mixer.muted[ch] = ch != channel
+                if mixer.muted[ch]:
                     self.allnotesoff(ch)
         elif 'level' in info:
-            self.channel[channel]['level'] = info['level']
-            self.writemidi([0xb0 + channel, 7, info['level']])
+            mixer.level[channel] = info['level']
+            self.writemidi([0xb0 + status, 7, info['level']])
         elif 'sense' in info:
-            self.channel[channel]['sense'] = info['sense']
+            mixer.sense[channel] = info['sense']
             block = (1, 2, 3, 4, 5, 6, 7, 8, 9, 0, 10, 11, 12, 13, 14, 15)
-            self.device.mididataset1(0x40101a + block[channel] << 8,
-                                     info['sense'])
-            sleep(0.04)
+            device = self.devices[self.outputs[self.port]]
+            device.mididataset1(0x40101a + block[status] << 8,
+                                info['sense'])
+            if getattr(device, 'sysex', True):
+                if not wait:
+                    return 0.04
+                self.clock.sleep(0.04)
         elif 'delay' in info:
-            self.channel[channel]['delay'] = info['delay']
-            self.writemidi([0xb0 + channel, 94, info['delay']])
+            mixer.delay[channel] = info['delay']
+            self.writemidi([0xb0 + status, 94, info['delay']])
         elif 'chorus' in info:
-            self.channel[channel]['chorus'] = info['chorus']
-            self.writemidi([0xb0 + channel, 93, info['chorus']])
+            mixer.chorus[channel] = info['chorus']
+            self.writemidi([0xb0 + status, 93, info['chorus']])
         elif 'reverb' in info:
-            self.channel[channel]['reverb'] = info['reverb']
-            self.writemidi([0xb0 + channel, 91, info['reverb']])
+            mixer.reverb[channel] = info['reverb']
+            self.writemidi([0xb0 + status, 91, info['reverb']])
         elif 'pan' in info:
-            self.channel[channel]['pan'] = info['pan']
-            self.writemidi([0xb0 + channel, 10, info['pan']])
+            mixer.pan[channel] = info['pan']
+            self.writemidi([0xb0 + status, 10, info['pan']])
         elif 'instrument' in info:
-            self.channel[channel]['instrument'] = info['instrument']
-            self.channel[channel]['name'] = instruments[info['instrument']]
-            self.writemidi([0xc0 + channel, info['instrument']])
+            mixer.instrument[channel] = info['instrument']
+            mixer.name[channel] = instruments[info['instrument']]
+            self.writemidi([0xc0 + status, info['instrument']])
 
     def timing(self, at):
         if at >= self.midi_clock:
             self.writemidi([0xf8])
             self.midi_clock += self.division / 24
 
+    def metaevent(self, at, me_type, data):
+        if me_type == 0x05:
+            if data[0] in [13, 10]:
+                self.line = ''
+            else:
+                if data[-1] in [13, 10]:
+                    self.text = self.line + printable(data[:-1])
+                    self.line = ''
+                else:
+                    self.line += printable(data)
+                    self.text = self.line
+        elif me_type == 0x51:
+            self.tempo = (data[0] << 16) | (data[1] << 8) | data[2]
+            self.tempomap.append(at, self.tempo)
+            self.bpm = 60000000 / self.tempo * self.denominator / 4 * \
+                self.speed
+        elif me_type == 0x58:
+            self.numerator = data[0]
+            self.denominator = 1 << data[1]
+            self.clocks_per_beat = data[2]
+            self.notes_per_quarter = data[3]
+        elif me_type == 0x59:
+            self.key = data[0]
+            self.mode = data[1]
+            if self.key < -7 or self.key > 8:
+                self.key = 8
+            if self.mode < 0 or self.mode > 2:
+                self.mode = 2
+
+    def channelevent(self, message, byte1, byte2):
+        self.execute(*instruction(message, byte1, byte2))
+
+    def execute(self, op, buf):
+        channel = self.port << 4 | buf[0] & 0x0f
+        mixer = self.mixer
+        mixer.used[channel] = True
+        if op == NOTEOFF or op == NOTEON:
+            byte1 = buf[1]
+            if channel & 0x0f != 9 and self.key_shift:
+                byte1 += self.key_shift
+                buf = [buf[0], byte1, buf[2]]
+            velocity = buf[2]
+            key = channel << 8 | byte1 & 0xff
+            held = self.held
+            if op == NOTEOFF or velocity == 0:
+                velocity = 0
+                if held[key]:
+                    held[key] -= 1
+                    if not held[key]:
+                        mixer.notes[channel].remove(byte1)
+                        if self.chordal[channel]:
+                            self.pitches[byte1 % 12] -= 1
+            else:
+                if held[key]:
+                    print('Note retriggered')
+                else:
+                    mixer.notes[channel].append(byte1)
+                    if self.chordal[channel]:
+                        self.pitches[byte1 % 12] += 1
+                held[key] += 1
+                if not mixer.muted[channel]:
+                    mixer.intensity[channel] = velocity
+            mixer.velocity[channel] = velocity
+        elif op == CONTROL:
+            control = mixer.controls.get(buf[1])
+            if control is not None:
+                control[channel] = buf[2]
+                if buf[1] == 7 and self.gain != 1:
+                    buf = [buf[0], 7, int(buf[2] * self.gain)]
+        elif op == PROGRAM:
+            mixer.name[channel] = instruments[buf[1]]
+            mixer.instrument[channel] = buf[1]
+            mixer.family[channel] = families[buf[1] // 8]
+            chordal = channel & 0x0f != 9 and \
+                mixer.family[channel] != 'Bass' and self.chordmap is None
+            if chordal != self.chordal[channel]:
+                for note in mixer.notes[channel]:
+                    self.pitches[note % 12] += 1 if chordal else -1
+                self.chordal[channel] = chordal
+        if not mixer.muted[channel]:
+            self.writemidi(buf)
+
+    if csmf is not None:
+        execute = csmf.execute
+
+    def decay(self, step):
+        self.mixer.decay(step)
+
+    def end(self):
+        # when the last event is due, in clock time
+        if self.program is None or not len(self.program):
+            return self.clock.time()
+        return self.elapsed_time + self.program.time[-1] / self.speed
+
+    def fade(self, gain):
+        # scales the volume (CC7) of all channels, including the levels
+        # the song sets later on
+        self.gain = gain
+        for channel in range(len(self.channel)):
+            self.port = channel >> 4
+            self.writemidi([0xb0 + (channel & 0x0f), 7,
+                            int(self.mixer.level[channel] * gain)])
+
+    def begin(self, dev, at=None):
+        # compiles the song and resets the device; play() does this on
+        # its first call unless done before. Given a start time `at`,
+        # the device is left as it is, to follow on from another song.
+        # `dev` may also be a list of devices, one per port in the order
+        # the song first uses them; ports past the end of the list share
+        # the first device
+        if not isinstance(dev, (list, tuple)):
+            dev = [dev]
+        self.device = dev[0]
+        self.devices = []
+        self.outputs = []
+        for port in range(self.ports):
+            device = dev[port] if port < len(dev) else dev[0]
+            if device not in self.devices:
+                self.devices.append(device)
+            self.outputs.append(self.devices.index(device))
+        self.running = [0] * len(self.devices)
+        self.routed = len(self.devices) > 1
+        self.batches = [None] * len(self.devices)
+        self.timestamps = all(getattr(device, 'timestamps', False)
+                              for device in self.devices)
+        if self.program is None and isinstance(self.ev, EventStore):
+            self.program = Program(self.ev, self.tempomap)
+        if at is None:
+            for device in self.devices:
+                device.mididataset1(0x40007f, 0x00)
+            if any(getattr(device, 'sysex', True)
+                   for device in self.devices):
+                self.clock.sleep(0.04)
+            at = self.clock.time()
+        self.start = at
+        self.writemidi([0xfc, 0xfa])
+        self.elapsed_time = self.start
+        self.line = ''
+
     def play(self, dev, wait=True):
         if not self.start:
-            self.device = dev
-            self.device.mididataset1(0x40007f, 0x00)
-            sleep(0.04)
-            self.start = time()
-            self.writemidi([0xfc, 0xfa])
-            self.elapsed_time = self.start
-            self.line = ''
+            self.begin(dev)
         if self.pause != 0:
             return 0.04
-        for ev in self.ev[self.next:]:
+        if self.program is None:
+            return self.playstream(wait)
+        for output, device in enumerate(self.devices):
+            if getattr(device, 'batch', False):
+                self.batches[output] = self.batch = []
+        try:
+            return self.playprogram(wait)
+        finally:
+            self.flush()
+            self.batches = [None] * len(self.devices)
+            self.batch = None
+
+    def playprogram(self, wait):
+        # with a batching device the messages due are collected and
+        # handed over together; a device taking timestamps gets them
+        # up to self.lookahead seconds in advance
+        times = self.program.time
+        opcode = self.program.opcode
+        message = self.program.message
+        port = self.program.port
+        ticks = self.ev.tick
+        execute = self.execute
+        batch = self.batch
+        ahead = 0
+        if batch is not None and self.timestamps:
+            ahead = self.lookahead * self.speed
+        now = (self.clock.time() - self.elapsed_time) * self.speed
+        while self.next < len(times):
+            i = self.next
+            due = times[i]
+            if due > now + ahead:
+                now = (self.clock.time() - self.elapsed_time) * self.speed
+            while due > now + ahead:
+                if batch is not None:
+                    self.stamp = max(self.elapsed_time + (now + ahead) /
+                                     self.speed, self.scheduled)
+                self.timing(ticks[i])
+                self.flush()
+                delta = min((due - ahead - now) / self.speed,
+                            1.0 / (self.division / 24))
+                if wait:
+                    self.clock.sleep(delta)
+                    now = (self.clock.time() - self.elapsed_time) * self.speed
+                else:
+                    return delta
+            if batch is not None:
+                self.stamp = self.elapsed_time + due / self.speed
+                if self.stamp < self.scheduled:
+                    self.stamp = self.scheduled
+            if ticks[i] >= self.midi_clock:
+                self.timing(ticks[i])
+            op = opcode[i]
+            if op == META:
+                self.metaevent(ticks[i], self.ev.data1[i], message[i])
+            elif op != NOP:
+                if port is not None:
+                    self.port = port[i]
+                execute(op, message[i])
+            self.next = i + 1
+        self.writemidi([0xfc])
+        return 0
+
+    if csmf is not None:
+        playprogram = csmf.playprogram
+
+    def playstream(self, wait):
+        for ev in self.ev.events(self.next):
             (at, message, byte1, byte2) = ev
-            now = time() - self.elapsed_time
-            while at > now * self.division * 1000000 / self.tempo:
+            due = self.tempomap.seconds(at)
+            now = (self.clock.time() - self.elapsed_time) * self.speed
+            while due > now:
                 self.timing(at)
-                delta = (at - now * self.division * 1000000 / self.tempo) / \
-                    1000
-                delta = min(delta, 1.0 / (self.division / 24))
+                delta = min((due - now) / self.speed,
+                            1.0 / (self.division / 24))
                 if wait:
-                    sleep(delta)
-                    now = time() - self.elapsed_time
+                    self.clock.sleep(delta)
+                    now = (self.clock.time() - self.elapsed_time) * self.speed
                 else:
                     return delta
             self.timing(at)
             if message == 0xff:
-                (at, message, me_type, data) = ev
-                if me_type == 0x05:
-                    if data[0] in [13, 10]:
-                        self.line = ''
-                    else:
-                        if data[-1] in [13, 10]:
-                            self.text = self.line + printable(data[:-1])
-                            self.line = ''
-                        else:
-                            self.line += printable(data)
-                            self.text = self.line
-                elif me_type == 0x51:
-                    now = time()
-                    tempo = self.tempo
-                    self.tempo = (data[0] << 16) | (data[1] << 8) | data[2]
-                    self.bpm = 60000000 / self.tempo * self.denominator / 4
-                    self.elapsed_time = now - (now - self.elapsed_time) * \
-                        self.tempo / tempo
-                elif me_type == 0x58:
-                    self.numerator = data[0]
-                    self.denominator = 1 << data[1]
-                    self.clocks_per_beat = data[2]
-                    self.notes_per_quarter = data[3]
-                elif me_type == 0x59:
-                    self.key = data[0]
-                    self.mode = data[1]
-                    if self.key < -7 or self.key > 8:
-                        self.key = 8
-                    if self.mode < 0 or self.mode > 2:
-                        self.mode = 2
+                self.metaevent(at, byte1, byte2)
             else:
-                me_type = message & 0xf0
-                channel = message & 0x0f
-                info = self.channel[channel]
-                info['used'] = True
-                if me_type in [0x80, 0x90] and channel != 9:
-                    byte1 += self.key_shift
-                if me_type == 0x80:
-                    if byte1 in info['notes']:
-                        info['notes'].remove(byte1)
-                    info['velocity'] = 0
-                elif me_type == 0x90:
-                    if byte2 != 0:
-                        if byte1 in info['notes']:
-                            print('Note retriggered')
-                        else:
-                            info['notes'].append(byte1)
-                        if not info['muted']:
-                            info['intensity'] = byte2
-                    elif byte1 in info['notes']:
-                        info['notes'].remove(byte1)
-                    info['velocity'] = byte2
-                elif me_type == 0xb0:
-                    if byte1 == 0:
-                        info['variation'] = byte2
-                    elif byte1 == 32:
-                        byte2 = 2
-                    elif byte1 == 7:
-                        info['level'] = byte2
-                    elif byte1 == 10:
-                        info['pan'] = byte2
-                    elif byte1 == 91:
-                        info['reverb'] = byte2
-                    elif byte1 == 93:
-                        info['chorus'] = byte2
-                    elif byte1 == 94:
-                        info['delay'] = byte2
-                elif me_type == 0xc0:
-                    info['name'] = instruments[byte1]
-                    info['instrument'] = byte1
-                    info['family'] = families[byte1 // 8]
-                if not info['muted']:
-                    if me_type != 0xc0:
-                        self.writemidi([message, byte1, byte2])
-                    else:
-                        self.writemidi([message, byte1])
+                self.channelevent(message, byte1, byte2)
             self.next += 1
         self.writemidi([0xfc])
         return 0
 
 
-def read(path):
+def read(path, mapped=False, streaming=False, workers=0):
     midi = SMF()
-    midi.read(path)
+    midi.read(path, mapped, streaming, workers)
     return midi
 
 
@@ -643,6 +1684,20 @@ def play(midi, dev, wait=True):
     return midi.play(dev, wait)
 
 
+def render(midi, path=None):
+    """Plays a song as fast as possible and returns what was sent.
+
+    The song runs on a virtual clock into a sink device that records
+    (time, message) pairs, optionally also writing them to `path`.
+    """
+    import sinkmidi
+    midi.clock = VirtualClock()
+    dev = sinkmidi.midiDevice(midi.clock, path)
+    midi.play(dev)
+    dev.close()
+    return dev.log
+
+
 def fileinfo(midi):
     return midi.fileinfo()
 
@@ -671,12 +1726,18 @@ def channelinfo(midi, channel):
     return midi.channelinfo(channel)
 
 
+def decay(midi, step):
+    midi.decay(step)
+
+
 def setchannel(midi, channel, **info):
-    midi.setchannel(channel, **info)
+    return midi.setchannel(channel, **info)
 
 
 if __name__ == '__main__':
+    import mididevices
+
     midi_file = read(sys.argv[1])
-    midi_device = midiDevice()
+    midi_device = mididevices.open()
     midi_device.mididataset1(0x400130, 0x04)
     play(midi_file, midi_device)
@@ -0,0 +1,121 @@
+from __future__ import absolute_import, division
+
+import sys
+import os
+import hashlib
+import struct
+from array import array
+
+version = 3
+cache_dir = os.environ.get('MPLAY_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.cache',
+                                        'mplay'))
+max_size = 64 * 1024 * 1024
+# save() only looks through the directory when its estimate of the cache
+# size goes over max_size, or after `rescan` saves to catch up with
+# other processes. It then evicts down to `low` of max_size, so that the
+# next look is a while off
+rescan = 64
+low = 0.75
+estimate = None
+saves = 0
+
+magic = b'SMFC'
+header = struct.Struct('<4sHHHHd')
+columns = ('tick', 'status', 'data1', 'data2', 'offset', 'length', 'port')
+
+
+def entry(data):
+    return os.path.join(cache_dir, '%s-%d-%s' % (
+        hashlib.sha1(data).hexdigest(), version, sys.byteorder))
+
+
+def dump(f, values):
+    f.write(struct.pack('<cI', values.typecode.encode('ascii'), len(values)))
+    f.write(values.tobytes())
+
+
+def undump(f):
+    typecode, n = struct.unpack('<cI', f.read(5))
+    values = array(typecode.decode('ascii'))
+    data = f.read(n * values.itemsize)
+    if len(data) != n * values.itemsize:
+        raise ValueError('truncated cache entry')
+    values.frombytes(data)
+    return values
+
+
+def load(midi, data):
+    path = entry(data)
+    try:
+        with open(path, 'rb') as f:
+            fields = header.unpack(f.read(header.size))
+            if fields[0] != magic or fields[1] != version:
+                raise ValueError('invalid cache entry')
+            ev = [undump(f) for column in columns]
+            pool = undump(f)
+            tempomap = [undump(f) for column in ('at', 'tempo', 'usecs')]
+        os.utime(path, None)
+    except (IOError, OSError):
+        return False
+    except (ValueError, struct.error):
+        os.remove(path)
+        return False
+    (tag, cache_version, midi.format, midi.tracks, midi.division,
+     midi.playing_time) = fields
+    for column, values in zip(columns, ev):
+        setattr(midi.ev, column, values)
+    midi.ev.pool = bytearray(pool)
+    midi.tempomap.division = midi.division
+    midi.tempomap.at, midi.tempomap.tempo, midi.tempomap.usecs = tempomap
+    return True
+
+
+def save(midi, data):
+    global estimate, saves
+    path = entry(data)
+    temp = '%s.%d' % (path, os.getpid())
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(temp, 'wb') as f:
+            f.write(header.pack(magic, version, midi.format, midi.tracks,
+                                midi.division, midi.playing_time))
+            for column in columns:
+                dump(f, getattr(midi.ev, column))
+            dump(f, array('B', midi.ev.pool))
+            for column in ('at', 'tempo', 'usecs'):
+                dump(f, getattr(midi.tempomap, column))
+        os.rename(temp, path)
+        saves += 1
+        if estimate is not None:
+            estimate += os.path.getsize(path)
+        if estimate is None or estimate > max_size or saves % rescan == 0:
+            estimate = evict(int(max_size * low))
+    except (IOError, OSError):
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def evict(limit=None):
+    # removes the least recently used entries down to `limit` bytes and
+    # returns the size left
+    if limit is None:
+        limit = max_size
+    entries = []
+    for name in os.listdir(cache_dir):
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue  # removed by another process
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for mtime, size, name in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        total -= size
+    return total
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import os
+import sqlite3
+from multiprocessing import Pool
+from time import time
+
+import smf
+
+extensions = ('.mid', '.midi', '.kar', '.smf')
+
+schema = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    format INTEGER,
+    tracks INTEGER,
+    playing_time REAL,
+    key TEXT,
+    min_bpm REAL,
+    max_bpm REAL,
+    lyrics INTEGER,
+    error TEXT);
+CREATE TABLE IF NOT EXISTS instruments (
+    path TEXT,
+    channel INTEGER,
+    program INTEGER);
+CREATE INDEX IF NOT EXISTS instruments_path ON instruments (path);
+CREATE INDEX IF NOT EXISTS instruments_program ON instruments (program);
+'''
+
+
+def midifiles(root):
+    for directory, subdirs, files in os.walk(root):
+        for name in files:
+            if name.lower().endswith(extensions):
+                yield os.path.abspath(os.path.join(directory, name))
+
+
+def describe(path):
+    programs = set()
+    mtime = size = None
+    try:
+        stat = os.stat(path)
+        mtime, size = stat.st_mtime, stat.st_size
+        midi = smf.read(path)
+        # read() leaves files it cannot make sense of empty
+        if bytes(midi.mf[:4]) != b'MThd':
+            raise ValueError('not a standard MIDI file')
+        if midi.tracks == 0:
+            raise ValueError('no tracks')
+        key = None
+        lyrics = False
+        for at, message, byte1, byte2 in midi.ev:
+            if message == 0xff:
+                if byte1 == 0x05:
+                    lyrics = True
+                elif byte1 == 0x59 and key is None:
+                    sf = byte2[0] - 256 if byte2[0] > 127 else byte2[0]
+                    if -7 <= sf <= 7 and byte2[1] <= 1:
+                        key = (smf.keys[sf + 7] +
+                               smf.modes[byte2[1]]).strip()
+            elif message & 0xf0 == 0xc0:
+                programs.add((message & 0x0f, byte1))
+        bpm = [60000000 / tempo for tempo in midi.tempomap.tempo]
+        row = (midi.format, midi.tracks, midi.playing_time / 1000, key,
+               min(bpm), max(bpm), lyrics, None)
+    except Exception as e:
+        row = (None, None, None, None, None, None, None, str(e) or repr(e))
+    return (path, mtime, size) + row, sorted(programs)
+
+
+def init():
+    smf.cache = False
+
+
+def scan(root, database='catalog.db', processes=None):
+    start = time()
+    db = sqlite3.connect(database)
+    db.executescript(schema)
+    known = dict((path, (mtime, size)) for path, mtime, size in
+                 db.execute('SELECT path, mtime, size FROM files'))
+    found = set()
+    todo = []
+    for path in midifiles(root):
+        found.add(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            todo.append(path)  # describe() records the error
+            continue
+        if known.get(path) != (stat.st_mtime, stat.st_size):
+            todo.append(path)
+    prefix = os.path.join(os.path.abspath(root), '')
+    gone = [(path,) for path in known
+            if path.startswith(prefix) and path not in found]
+    db.executemany('DELETE FROM files WHERE path = ?', gone)
+    db.executemany('DELETE FROM instruments WHERE path = ?', gone)
+
+    pool = Pool(processes, init)
+    try:
+        for row, programs in pool.imap_unordered(describe, todo, 16):
+            db.execute('DELETE FROM instruments WHERE path = ?', row[:1])
+            db.execute('INSERT OR REPLACE INTO files VALUES '
+                       '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            db.executemany('INSERT INTO instruments VALUES (?, ?, ?)',
+                           [(row[0], channel, program)
+                            for channel, program in programs])
+    finally:
+        pool.close()
+        pool.join()
+        db.commit()
+        db.close()
+    elapsed = time() - start
+    return len(todo), len(found) - len(todo), elapsed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: smfcatalog.py directory [catalog.db]')
+        sys.exit(1)
+    scanned, unchanged, elapsed = scan(*sys.argv[1:3])
+    print('%d files scanned, %d unchanged in %.1f s (%.1f files/s)' % (
+        scanned, unchanged, elapsed, scanned / elapsed if elapsed else 0))
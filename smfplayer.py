@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import os
+import threading
+from heapq import heappop, heappush
+from time import sleep
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import smf
+from smf import clock
+
+
+class Timer(threading.Thread):
+    """A thread waiting for deadlines.
+
+    Sleeps until shortly before a deadline and spins for the rest, so
+    that it wakes up within `precision` seconds even if the operating
+    system oversleeps. The spin window adapts to the oversleep actually
+    observed. Waiting ends early when notify() is called.
+    """
+
+    def __init__(self, precision=0.0005, spin=0.002):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.precision = precision
+        self.spin = spin
+        self.lock = threading.RLock()
+        self.wake = threading.Condition(self.lock)
+        self.running = False
+        self.changed = False
+
+    def wait(self, deadline):
+        slept = False
+        with self.lock:
+            while not self.changed:
+                remaining = deadline - clock()
+                if remaining <= self.spin:
+                    break
+                self.wake.wait(remaining - self.spin)
+                slept = True
+            else:
+                return
+        if slept and self.spin:
+            late = self.spin - (deadline - clock())
+            if late > self.spin - self.precision:
+                self.spin = min(late + self.precision, 0.02)
+            else:
+                self.spin = max(self.spin * 0.99, self.precision)
+        while clock() < deadline:
+            sleep(0)
+
+    def notify(self):
+        self.changed = True
+        self.wake.notify()
+
+
+class Scheduler(Timer):
+    """Plays a song on its own thread.
+
+    `device` may be a list of devices, one per MIDI port of the song.
+    With a `lookahead` (in seconds) and a device taking timestamps,
+    messages are handed over in advance and the device does the
+    timing, so there is no need to spin.
+    """
+
+    def __init__(self, midi, device, precision=0.0005, spin=0.002,
+                 lookahead=0):
+        Timer.__init__(self, precision, spin)
+        self.midi = midi
+        self.device = device
+        devices = device if isinstance(device, (list, tuple)) else [device]
+        if lookahead and all(getattr(device, 'timestamps', False)
+                             for device in devices):
+            self.spin = 0
+        midi.lookahead = lookahead
+
+    def run(self):
+        self.running = True
+        while True:
+            with self.lock:
+                if not self.running:
+                    break
+                if self.midi.pause != 0:
+                    self.wake.wait()
+                    continue
+                self.changed = False
+                delta = self.midi.play(self.device, wait=False)
+                if delta <= 0:
+                    break
+            self.wait(clock() + delta)
+        self.running = False
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.notify()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        with self.lock:
+            for channel in range(len(self.midi.channel)):
+                self.midi.allnotesoff(channel)
+
+    def pause(self):
+        with self.lock:
+            if self.midi.pause == 0:
+                self.midi.setsong(action='pause')
+                self.notify()
+
+    def resume(self):
+        with self.lock:
+            if self.midi.pause != 0:
+                self.midi.setsong(action='pause')
+                self.notify()
+
+    def seek(self, beat):
+        with self.lock:
+            self.midi.setsong(beat=beat)
+            self.notify()
+
+    def setsong(self, **info):
+        with self.lock:
+            self.midi.setsong(**info)
+            self.notify()
+
+    def setchannel(self, channel, **info):
+        # the synth may need a moment after a change, which is waited
+        # out here rather than holding up playback
+        with self.lock:
+            midi = self.midi
+            pause = midi.setchannel(channel, wait=False, **info)
+        if pause:
+            midi.clock.sleep(pause)
+
+
+class Playlist(Scheduler):
+    """Plays songs one after another without a gap.
+
+    A worker reads and compiles the next songs while the current one
+    plays, keeping at most `ahead` of them in memory. Each song starts
+    exactly when the last event of the one before is due, and the
+    device is not reset in between. With a `crossfade` (in seconds),
+    the volume ramps down over the end of each song and up over the
+    start of the next.
+    """
+
+    steps = 32
+
+    def __init__(self, paths, device, ahead=2, crossfade=0, **options):
+        self.songs = queue.Queue(ahead)
+        self.loader = threading.Thread(target=self.load, args=(paths,))
+        self.loader.daemon = True
+        self.loader.start()
+        midi = self.songs.get()
+        if midi is None:
+            self.songs.put(None)
+        Scheduler.__init__(self, midi or smf.SMF(), device, **options)
+        self.crossfade = crossfade
+        self.level = None
+
+    def load(self, paths):
+        for path in paths:
+            try:
+                midi = smf.read(path)
+            except (IOError, OSError) as e:
+                print('unable to read %s: %s' % (path, e))
+                continue
+            if isinstance(midi.ev, smf.EventStore):
+                midi.program = smf.Program(midi.ev, midi.tempomap)
+            self.songs.put(midi)
+        self.songs.put(None)
+
+    def run(self):
+        self.running = True
+        while True:
+            with self.lock:
+                if not self.running:
+                    break
+                if self.midi.pause != 0:
+                    self.wake.wait()
+                    continue
+                self.changed = False
+                delta = self.midi.play(self.device, wait=False)
+                if delta > 0 and self.crossfade:
+                    delta = min(delta, self.ramp())
+            if delta <= 0 and not self.advance():
+                break
+            self.wait(clock() + max(delta, 0))
+        self.running = False
+
+    def ramp(self):
+        # adjusts the volume during a crossfade and tells how soon to
+        # come back for the next step
+        midi = self.midi
+        length = midi.program.time[-1] if midi.program else 0
+        at = midi.position()
+        gain = min(at / self.crossfade, (length - at) / self.crossfade, 1)
+        gain = max(gain, 0)
+        if self.level is None or abs(gain - self.level) >= 1 / self.steps \
+                or (gain != self.level and gain in (0, 1)):
+            midi.fade(gain)
+            self.level = gain
+        if gain < 1 or length - at < self.crossfade:
+            return self.crossfade / self.steps / midi.speed
+        return (length - at - self.crossfade) / midi.speed
+
+    def advance(self):
+        midi = self.songs.get()
+        if midi is None:
+            return False
+        with self.lock:
+            if not self.running:
+                return False
+            previous = self.midi
+            midi.clock = previous.clock
+            midi.lookahead = previous.lookahead
+            # the listener's settings carry over: transposition, tempo
+            # and muted channels (as far as both songs have ports)
+            midi.key_shift = previous.key_shift
+            midi.bpm *= previous.speed / midi.speed
+            midi.speed = previous.speed
+            muted = previous.mixer.muted[:len(midi.mixer.muted)]
+            midi.mixer.muted[:len(muted)] = muted
+            # unless this song was not ready in time, there is no gap
+            midi.begin(self.device, max(previous.end(),
+                                        midi.clock.time() - 0.01))
+            self.midi = midi
+            self.level = None
+        return True
+
+
+class Engine(Timer):
+    """Plays any number of songs, each on its own device, on one thread.
+
+    The songs wait in a heap ordered by when each is due next, so a
+    pass only touches the songs that have events to send. Every song
+    keeps its own tempo, pause state and position; controlling one
+    reschedules it, and superseded heap entries are skipped.
+    """
+
+    def __init__(self, precision=0.0005, spin=0.002):
+        Timer.__init__(self, precision, spin)
+        self.songs = []
+        self.generation = []
+        self.queue = []
+
+    def add(self, midi, device):
+        # songs are set up here, so that compiling one and waiting for
+        # its device to reset do not hold up the others
+        if not midi.start:
+            midi.begin(device)
+        with self.lock:
+            self.songs.append((midi, device))
+            self.generation.append(0)
+            index = len(self.songs) - 1
+            self.reschedule(index)
+        return index
+
+    def remove(self, index):
+        with self.lock:
+            midi = self.songs[index][0]
+            for channel in range(len(midi.channel)):
+                midi.allnotesoff(channel)
+            self.songs[index] = None
+            self.generation[index] += 1
+
+    def reschedule(self, index):
+        self.generation[index] += 1
+        song = self.songs[index]
+        if song is not None and song[0].pause == 0:
+            heappush(self.queue, (clock(), self.generation[index], index))
+        self.notify()
+
+    def playing(self):
+        with self.lock:
+            return len(set(index for deadline, generation, index in
+                           self.queue
+                           if generation == self.generation[index]))
+
+    def run(self):
+        self.running = True
+        queue = self.queue
+        while True:
+            with self.lock:
+                if not self.running:
+                    break
+                self.changed = False
+                now = clock()
+                while queue and queue[0][0] <= now:
+                    deadline, generation, index = heappop(queue)
+                    if generation != self.generation[index]:
+                        continue
+                    midi, device = self.songs[index]
+                    delta = midi.play(device, wait=False)
+                    if delta > 0 and midi.pause == 0:
+                        heappush(queue, (clock() + delta, generation, index))
+                if not queue:
+                    while not self.changed and self.running:
+                        self.wake.wait()
+                    continue
+                deadline = queue[0][0]
+            self.wait(deadline)
+        self.running = False
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.notify()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        with self.lock:
+            for song in self.songs:
+                if song is not None:
+                    for channel in range(len(song[0].channel)):
+                        song[0].allnotesoff(channel)
+
+    def pause(self, index):
+        with self.lock:
+            if self.songs[index][0].pause == 0:
+                self.songs[index][0].setsong(action='pause')
+                self.reschedule(index)
+
+    def resume(self, index):
+        with self.lock:
+            if self.songs[index][0].pause != 0:
+                self.songs[index][0].setsong(action='pause')
+                self.reschedule(index)
+
+    def seek(self, index, beat):
+        self.setsong(index, beat=beat)
+
+    def setsong(self, index, **info):
+        with self.lock:
+            self.songs[index][0].setsong(**info)
+            self.reschedule(index)
+
+    def setchannel(self, index, channel, **info):
+        with self.lock:
+            midi = self.songs[index][0]
+            pause = midi.setchannel(channel, wait=False, **info)
+        if pause:
+            midi.clock.sleep(pause)
+
+
+class NullDevice:
+    def midievent(self, buf):
+        pass
+
+    def mididataset1(self, address, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def lateness(midi, late=None):
+    """Records how late each channel message is dispatched."""
+    if late is None:
+        late = []
+    dispatch = midi.execute
+
+    def execute(op, buf):
+        at = midi.ev.tick[midi.next]
+        due = midi.elapsed_time + midi.tempomap.seconds(at) / midi.speed
+        late.append(clock() - due)
+        dispatch(op, buf)
+
+    midi.execute = execute
+    return late
+
+
+def report(name, late):
+    late = sorted(late)
+    if not late:
+        print('%-9s no events' % name)
+        return
+    print('%-9s %6d events  mean %7.3f  p50 %7.3f  p99 %7.3f  '
+          'max %7.3f ms' % (name, len(late), 1000 * sum(late) / len(late),
+                             1000 * late[len(late) // 2],
+                             1000 * late[len(late) * 99 // 100],
+                             1000 * late[-1]))
+
+
+def jitter(path, seconds=10, frame=0.005, precision=0.0005):
+    """Compares dispatch lateness of the idle loop and the scheduler.
+
+    The idle loop is driven like Player.process_events, with each
+    pass followed by a redraw taking `frame` seconds.
+    """
+    device = NullDevice()
+
+    midi = smf.read(path)
+    late = lateness(midi)
+    end = clock() + seconds
+    while clock() < end:
+        delta = midi.play(device, wait=False)
+        if delta <= 0:
+            break
+        sleep(delta)
+        sleep(frame)
+    report('loop', late)
+
+    midi = smf.read(path)
+    late = lateness(midi)
+    scheduler = Scheduler(midi, device, precision)
+    scheduler.start()
+    end = clock() + seconds
+    while scheduler.is_alive() and clock() < end:
+        sleep(frame)
+    scheduler.stop()
+    report('scheduler', late)
+
+
+def scaling(path, seconds=10, counts=(1, 2, 4, 8, 16, 32, 64),
+            precision=0.0005):
+    """Plays `path` as 1, 2, 4, ... songs at once on one Engine.
+
+    Reports the CPU time used per second played and how late channel
+    messages are dispatched, over all songs.
+    """
+    for count in counts:
+        engine = Engine(precision)
+        engine.start()
+        late = []
+        times = os.times()
+        start = clock()
+        for song in range(count):
+            midi = smf.read(path)
+            late = lateness(midi, late)
+            engine.add(midi, NullDevice())
+        while engine.playing() and clock() < start + seconds:
+            sleep(0.1)
+        engine.stop()
+        elapsed = clock() - start
+        cpu = sum(os.times()[:2]) - sum(times[:2])
+        print('%3d songs  cpu %5.1f%%' % (count, 100 * cpu / elapsed),
+              end='  ')
+        report('', late)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: smfplayer.py file [seconds [frame]]\n'
+              '       smfplayer.py -n file [seconds]')
+        sys.exit(1)
+    if sys.argv[1] == '-n':
+        scaling(sys.argv[2], *[float(arg) for arg in sys.argv[3:4]])
+    else:
+        jitter(sys.argv[1], *[float(arg) for arg in sys.argv[2:4]])
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Checks that the compiled csmf loops behave exactly like the pure Python
+ones in smf.
+
+    python csetup.py build_ext --inplace
+    python -m unittest test_csmf
+
+Skipped unless csmf has been built.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import io
+import random
+import struct
+import tempfile
+import unittest
+import contextlib
+
+import smf
+
+columns = ('tick', 'status', 'data1', 'data2', 'offset', 'length', 'port')
+
+
+def purecopy():
+    # a second smf module, imported without csmf
+    from importlib.util import spec_from_file_location, module_from_spec
+    spec = spec_from_file_location('smf_pure', smf.__file__)
+    module = module_from_spec(spec)
+    os.environ['MPLAY_PURE'] = '1'
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        del os.environ['MPLAY_PURE']
+    return module
+
+
+def number(value):
+    data = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        data.insert(0, value & 0x7f | 0x80)
+        value >>= 7
+    return data
+
+
+def track(events):
+    data = bytearray()
+    for delta, message in events:
+        data += number(delta) + message
+    data += b'\x00\xff\x2f\x00'
+    return b'MTrk' + struct.pack('>I', len(data)) + bytes(data)
+
+
+def song(tracks=6, beats=64, seed=1):
+    """A format 1 file using running status, system exclusive, lyrics,
+    tempo changes, several ports and a long variable length number."""
+    rnd = random.Random(seed)
+    conductor = [(0, b'\xff\x58\x04\x04\x02\x18\x08'),
+                 (0, b'\xff\x51\x03\x07\xa1\x20')]
+    for beat in range(0, beats, 16):
+        tempo = struct.pack('>I', rnd.randint(300000, 900000))[1:]
+        conductor.append((384 * 16, b'\xff\x51\x03' + tempo))
+    chunks = [track(conductor)]
+    for part in range(1, tracks):
+        channel = part % 16
+        events = [(0, bytearray((0xff, 0x21, 1, part % 3))),
+                  (0, bytearray((0xc0 | channel, rnd.randrange(128)))),
+                  (0, bytearray((0xb0 | channel, 7, rnd.randrange(128)))),
+                  (0, bytearray(b'\xf0\x05\x7e\x7f\x09\x01\xf7'))]
+        for beat in range(beats):
+            key = rnd.randrange(30, 90)
+            events.append((rnd.choice((0, 96, 384)),
+                           bytearray((0x90 | channel, key, 100))))
+            events.append((96, bytearray((key, 0))))  # running status
+            if part == 1:
+                events.append((0, bytearray(b'\xff\x05\x03la ')))
+            if rnd.random() < 0.2:
+                events.append((0, bytearray((0xe0 | channel, 0,
+                                             rnd.randrange(128)))))
+        events.append((1 << 27, bytearray((0x80 | channel, 60, 0))))
+        chunks.append(track(events))
+    return (b'MThd' + struct.pack('>IHHH', 6, 1, len(chunks), 384) +
+            b''.join(chunks))
+
+
+def state(ev):
+    return [getattr(ev, column).tolist() for column in columns], \
+        bytes(ev.pool)
+
+
+def events(ev):
+    return [tuple(bytes(value) if isinstance(value, (bytearray, memoryview))
+                  else value for value in event) for event in ev]
+
+
+@unittest.skipIf(smf.csmf is None, 'csmf is not built')
+class Parity(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pure = purecopy()
+        smf.cache = cls.pure.cache = False
+        handle, cls.path = tempfile.mkstemp('.mid')
+        os.write(handle, song())
+        os.close(handle)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.path)
+
+    def read(self, module, **options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return module.read(self.path, **options)
+
+    def test_read(self):
+        for options in ({}, {'mapped': True}):
+            compiled = self.read(smf, **options)
+            pure = self.read(self.pure, **options)
+            self.assertEqual(state(compiled.ev)[0], state(pure.ev)[0])
+            self.assertEqual(compiled.ports, pure.ports)
+
+    def test_stream(self):
+        compiled = self.read(smf, streaming=True)
+        pure = self.read(self.pure, streaming=True)
+        self.assertEqual(events(compiled.ev), events(pure.ev))
+
+    def decode(self, data, limit):
+        results = []
+        for decode in (smf.csmf.decode, None):
+            ev = smf.EventStore()
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if decode is None:
+                        result = smf.pydecode(data, 0, len(data), ev,
+                                              limit=limit)
+                    else:
+                        result = decode(data, 0, len(data), ev, 0, 0,
+                                        limit, smf.pydecode)
+            except Exception as e:
+                result = type(e).__name__
+            results.append((result, state(ev)))
+        return results
+
+    def test_corrupt(self):
+        rnd = random.Random(11)
+        data = song(3, 16)
+        body = data[22 + 8:]
+        for k in range(1500):
+            if k % 3 == 0:
+                stream = bytearray(rnd.randrange(256)
+                                   for i in range(rnd.randrange(1, 200)))
+            elif k % 3 == 1:
+                stream = bytearray(body[:rnd.randrange(1, len(body))])
+            else:
+                stream = bytearray(body)
+                for i in range(rnd.randrange(1, 60)):
+                    stream[rnd.randrange(len(stream))] = rnd.choice(
+                        (0xff, 0x80, 0xf0, 0x7f, rnd.randrange(256)))
+            compiled, pure = self.decode(stream, rnd.choice((0, 0, 7)))
+            self.assertEqual(compiled, pure, 'stream %d differs' % k)
+
+    def test_render(self):
+        for setup in (lambda midi: None,
+                      lambda midi: midi.setsong(shift=-3),
+                      lambda midi: midi.setchannel(17, muted=True)):
+            logs = []
+            for module in (smf, self.pure):
+                midi = self.read(module)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    setup(midi)
+                    logs.append(module.render(midi))
+            self.assertEqual(logs[0], logs[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
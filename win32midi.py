@@ -2,9 +2,14 @@ from ctypes import windll, c_void_p, c_int, byref
 
 
 class midiDevice:
+    batch = False
+    timestamps = False
+    sysex = False
+
     def __init__(self):
         self.device = c_void_p()
         windll.winmm.midiOutOpen(byref(self.device), -1, 0, 0, 0)
+        self.ports = windll.winmm.midiOutGetNumDevs()
 
     def midievent(self, buf):
         message = buf[0]
@@ -14,6 +19,10 @@ class midiDevice:
             message += buf[2] * 0x10000
         windll.winmm.midiOutShortMsg(self.device, c_int(message))
 
+    def midievents(self, events):
+        for stamp, buf in events:
+            self.midievent(buf)
+
     def mididataset1(self, address, data):
         pass
 
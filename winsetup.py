@@ -4,7 +4,7 @@ import py2exe
 setup(windows=['mplay.py'],
       options={
           'py2exe': {
-              'includes': ['ctypes', 'logging'],
+              'includes': ['ctypes', 'logging', 'mididevices', 'win32midi'],
               'excludes': ['OpenGL']
               }
           }